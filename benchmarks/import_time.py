@@ -0,0 +1,71 @@
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+# Modules imported by each `python -m stune` code path
+PATHS = {
+    "main": ["stune.__main__"],
+    "ls": ["stune.__main__", "optuna"],
+    "worker": ["stune.__main__", "stune.tune"],
+    "scheduler": ["stune.__main__", "stune.tune", "omegaconf", "names_generator"],
+}
+BASELINE = Path(__file__).with_suffix(".json")
+
+
+def measure(modules, repeat: int = 5) -> float:
+    # Best wall time (in ms) over several fresh interpreters, to reduce the noise of the file system cache
+    code = (
+        "import time; t = time.perf_counter(); "
+        + "; ".join(f"import {m}" for m in modules)
+        + "; print((time.perf_counter() - t) * 1000)"
+    )
+    times = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", code], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True,
+            cwd=Path(__file__).parents[1]
+        )
+        times.append(float(result.stdout))
+
+    return min(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the import time of each stune code path.")
+    parser.add_argument("--update", action="store_true", help="Save the measured times as the new baseline.")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="Maximum allowed ratio over the baseline.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of interpreters started per code path.")
+    args = parser.parse_args()
+
+    try:
+        with open(BASELINE, "r") as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+
+    results = {}
+    regressions = []
+    for name, modules in PATHS.items():
+        try:
+            results[name] = measure(modules, args.repeat)
+        except subprocess.CalledProcessError:
+            print(f"{name.ljust(12)} skipped (missing dependencies)")
+            continue
+
+        line = f"{name.ljust(12)} {results[name]:8.1f} ms"
+        if name in baseline:
+            ratio = results[name] / baseline[name]
+            line += f"  (baseline {baseline[name]:.1f} ms, x{ratio:.2f})"
+            if ratio > args.tolerance:
+                regressions.append(name)
+        print(line)
+
+    if args.update:
+        with open(BASELINE, "w") as f:
+            json.dump({k: round(v, 1) for k, v in results.items()}, f, indent=4)
+            f.write("\n")
+    elif regressions:
+        print(f"Import time regression in: {', '.join(regressions)}")
+        exit(1)
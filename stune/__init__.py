@@ -7,7 +7,13 @@ __all__ = [
 # from .log import (
 #     open_log
 # )
-from .utils import (
-    load_config,
-    RunInfo
-)
+
+
+# Exports are resolved lazily so that importing stune (e.g., by `python -m stune`) does not load all its dependencies
+def __getattr__(name):
+    if name in __all__:
+        from . import utils
+
+        return getattr(utils, name)
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -2,17 +2,25 @@ import json
 import os
 import argparse
 from pathlib import Path
-import enum
 
-from names_generator import generate_name
-from omegaconf import OmegaConf
-import optuna
+# NOTE: this module is executed by every worker (and srun rank), so heavy dependencies (optuna, omegaconf,
+# names_generator, and the tuning machinery) are only imported by the code paths that need them.
+from .utils import Study, Storage
 
-from .tune import run
-from .utils import Study, Storage, load_config
+
+def study_full_name(args) -> str:
+    # "<exec>.<study>" of an existing study, as given on the command line (e.g., "mnist.py --study sweeps/lr.yaml")
+    if args.exec is None or args.study is None:
+        print("This action requires the executable and the study, e.g., 'python -m stune <exec> --study <study>'.")
+
+        exit(1)
+
+    return f"{Path(args.exec).stem}.{Path(args.study).name.replace('.yaml', '')}"
 
 
 def action_info(storage: Storage, exec_name):
+    import optuna
+
     studies_info = action_ls(storage, exec_name)
 
     study = int(input("Study to load: "))
@@ -31,6 +39,8 @@ def action_info(storage: Storage, exec_name):
 
 
 def action_ls(storage: Storage, exec_name):
+    import optuna
+
     studies = optuna.get_all_study_summaries(storage.get(), False)
     studies_info = [(study.study_name, study.datetime_start) 
                     for study in studies if exec_name is None or study.study_name.startswith(exec_name)]
@@ -42,7 +52,9 @@ def action_ls(storage: Storage, exec_name):
 
 
 def action_rm(storage: Storage, exec_name):
+    import optuna
     from intspan import intspan
+
     studies_info = action_ls(storage, exec_name)
 
     rm = input("Studies to delete: ")
@@ -52,8 +64,33 @@ def action_rm(storage: Storage, exec_name):
         print(study_i, studies_info[study_i][0])
     c = input("\nContinue? [y/n] ")
     if c in ["y", "Y"]:
+        from .cache import remove_cache
+
         for study_i in studies_to_delete:
             optuna.delete_study(study_name=studies_info[study_i][0], storage=storage.get())
+            remove_cache(studies_info[study_i][0])
+
+
+def action_simulate(storage: Storage, args):
+    import optuna
+    from omegaconf import OmegaConf
+    from .simulate import simulate_study
+    from .tune import query_partition_maxtime
+
+    study_name = study_full_name(args)
+    study = optuna.load_study(study_name=study_name, storage=storage.get())
+
+    # The config saved by the scheduler, if the study was not run in debug mode
+    config_name = f".stune/config/{study_name}.cfg"
+    config = OmegaConf.load(config_name) if os.path.exists(config_name) else OmegaConf.create()
+
+    try:
+        max_minutes = query_partition_maxtime(args.partition)
+    except (OSError, IndexError, ValueError):
+        # Not on a SLURM node: the reservations are not capped unless the policies set max_minutes
+        max_minutes = None
+
+    print(simulate_study(study, config, OmegaConf.load(args.simulate), max_minutes))
 
 
 if __name__ == "__main__":
@@ -75,10 +112,13 @@ if __name__ == "__main__":
     parser.add_argument("--storage", type=str, help="URL of the storage host")
     parser.add_argument("-s", "--study", type=str, help="Name of the study to create (or load if it already exists)")
     parser.add_argument("-t", "--n_trials", type=str, help="Number of trials to run the optimization for (exclusive with n_minutes)")
-    parser.add_argument("--sampler", type=str, help="Sampler used by optuna: tpe(None)|random|grid")
+    parser.add_argument("--sampler", type=str, help="Sampler used by optuna: tpe(None)|random|grid|grid-shard")
     parser.add_argument("-d", "--debug", action="store_true", help="Whether to run the optimization in debug mode")
     parser.add_argument("-l", "--log", type=str, help="Log level: None|trial|study|all")
     parser.add_argument("--msg", type=str, help="Study description")
+    parser.add_argument("--profile", type=str, choices=["cpu", "memory"], help="Profile the trials with cProfile (cpu) \
+        or tracemalloc (memory)")
+    parser.add_argument("--profile-fraction", type=float, default=0.1, help="Fraction of the trials to profile")
     
     # Override config
     parser.add_argument(
@@ -94,9 +134,21 @@ if __name__ == "__main__":
     parser.add_argument("--ls", action="store_true", help="List all studies. If exec is specified list only the studies on it.")
     parser.add_argument("--rm", action="store_true", help="List all studies and ask for deletion. If exec is specified list only the studies on it.")
     parser.add_argument("--info", action="store_true", help="List all studies and ask for study to display. If exec is specified list only the studies on it.")
+    parser.add_argument("--profile-report", action="store_true", help="Merge the profiles of the study into a table \
+        of hotspots.")
+    parser.add_argument("--merge-metrics", action="store_true", help="Merge the metrics logged by the trials of the \
+        study into '.stune/metrics/<study>.npz'.")
+    parser.add_argument("--simulate", type=str, help="YAML file of scheduling policies to replay on the trials of \
+        the (finished) study, reporting the makespan, GPU-hour utilization and wasted reservation of each policy.")
+
+    # Co-scheduling arguments
+    parser.add_argument("--multi", type=str, help="Comma separated list of existing studies \
+        '<exec>.<study>[:<weight>]' to run within the same allocations. Each worker pulls the next trial from \
+        whichever study has work.")
 
     # Reserved arguments
     parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--rung", type=int, help=argparse.SUPPRESS)
 
     args = parser.parse_args()
     args.exec = args.exec.replace(".py", "") if args.exec else None
@@ -109,15 +161,41 @@ if __name__ == "__main__":
         action_rm(storage, args.exec)
     elif args.info:
         action_info(storage, args.exec)         
+    elif args.profile_report:
+        from .profiling import profile_report
+
+        print(profile_report(study_full_name(args)))
+    elif args.merge_metrics:
+        from .metrics import merge_metrics
+
+        print(merge_metrics(study_full_name(args)))
+    elif args.simulate:
+        action_simulate(storage, args)
+    elif args.multi:
+        from .multi import run_multi
+
+        run_multi(env, args.multi, storage, args.partition, args.n_jobs, debug=args.debug)
     else:
+        from .tune import run
+
         # Compute study_name and exec_name by removing all unnecessary extensions and parent dirs
         exec_name = Path(args.exec).stem
-        study_name = Path(args.study).name.replace(".yaml", "") or generate_name()
+        if args.n_jobs == -1:
+            # Worker fast path: the study name is always set and the config has already been created by the scheduler
+            study_name = Path(args.study).name
+        else:
+            study_name = Path(args.study or "").name.replace(".yaml", "")
+            if not study_name:
+                from names_generator import generate_name
+                study_name = generate_name()
         study = Study.init(args, exec_name, study_name)
 
         # Create config file if it is not worker
         config_name = f".stune/config/{study.name}.cfg"
         if study.is_worker() == False:
+            from omegaconf import OmegaConf
+            from .utils import load_config
+
             # Uses the raw args as they may contain the path to the files
             config = load_config(args.exec, args.study, args.config)
             OmegaConf.save(config, config_name)
@@ -130,7 +208,9 @@ if __name__ == "__main__":
                 config_name=config_name,
                 debug=args.debug,
                 log_level=args.log,
-                description=args.msg
+                description=args.msg,
+                profile=args.profile,
+                profile_fraction=args.profile_fraction
             )
         finally:
             if study.is_worker() == False and args.debug is True:
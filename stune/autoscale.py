@@ -0,0 +1,135 @@
+from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+import os
+import math
+import time
+import glob
+import subprocess
+
+import optuna
+
+from .slurm import Sbatch, acquire_lock, hold_lock
+from .utils import Study, Storage
+
+
+class Autoscaler:
+    """Keeps just enough array tasks of a study in flight to complete its trials.
+
+    The number of tasks to submit (or of pending tasks to cancel) is computed from the trials finished in the storage
+    and from the study's tasks in `squeue`. The squeue/scancel executables can be replaced, e.g., by fake ones for
+    testing.
+    """
+
+    def __init__(
+        self,
+        study: Study,
+        storage: Storage,
+        sbatch: Sbatch,
+        n_trials: int,
+        trials_per_task: int,
+        max_concurrent: Optional[int] = None,
+        squeue_bin: str = "squeue",
+        scancel_bin: str = "scancel"
+    ) -> None:
+        self.study = study
+        self.storage = storage
+        self.sbatch = sbatch
+        self.n_trials = n_trials
+        self.trials_per_task = max(1, trials_per_task)
+        self.max_concurrent = max_concurrent
+        self.squeue_bin = squeue_bin
+        self.scancel_bin = scancel_bin
+
+    def queue_state(self) -> Tuple[List[str], List[str]]:
+        # One line per array task (--array), e.g., "1234_5 PENDING"
+        r = subprocess.run(
+            [
+                self.squeue_bin, "--noheader", "--array", f"--name={self.sbatch.job_name}",
+                f"--user={os.environ.get('USER', '')}", "--format=%i %T"
+            ],
+            capture_output=True,
+            text=True
+        )
+        if r.returncode != 0:
+            raise RuntimeError(f"{self.squeue_bin} failed with exit code {r.returncode}: {r.stderr.strip()}")
+
+        pending, running = [], []
+        for line in r.stdout.splitlines():
+            if not line.strip():
+                continue
+            task_id, state = line.split()
+            if state == "PENDING":
+                pending.append(task_id)
+            elif state in ["RUNNING", "CONFIGURING", "COMPLETING"]:
+                running.append(task_id)
+
+        return pending, running
+
+    def trial_counts(self) -> Dict[str, int]:
+        counts = {"finished": 0, "running": 0, "waiting": 0, "failed": 0}
+        for trial in self.study.get(self.storage).get_trials(deepcopy=False):
+            if trial.state in [optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED]:
+                counts["finished"] += 1
+            elif trial.state == optuna.trial.TrialState.RUNNING:
+                counts["running"] += 1
+            elif trial.state == optuna.trial.TrialState.WAITING:
+                counts["waiting"] += 1
+            elif trial.state == optuna.trial.TrialState.FAIL:
+                counts["failed"] += 1
+
+        return counts
+
+    def n_tasks_needed(self, counts: Dict[str, int]) -> int:
+        # n_trials == 0 means the study runs until stopped, so the maximum number of tasks is kept in flight
+        if self.n_trials == 0:
+            return self.max_concurrent or 0
+
+        n_tasks = math.ceil(max(0, self.n_trials - counts["finished"]) / self.trials_per_task)
+        if self.max_concurrent is not None:
+            n_tasks = min(n_tasks, self.max_concurrent)
+
+        return n_tasks
+
+    def step(self, exiting: Optional[str] = None, delay_minutes: float = 0) -> Tuple[int, int]:
+        """Submit or cancel array tasks and return how many were submitted and cancelled.
+
+        exiting is the id of the array task calling the autoscaler at the end of its reservation (if any),
+        which is not counted as in flight, together with the other tasks that are exiting. The submitted tasks are
+        not started before delay_minutes (e.g., the backoff of the failure budget).
+        """
+        os.makedirs(self.sbatch.submit_dir, exist_ok=True)
+        prefix = os.path.join(self.sbatch.submit_dir, "")
+        if exiting is not None:
+            Path(f"{prefix}{exiting}.exit").touch()
+
+        # Scaling decisions are serialised, otherwise concurrent workers would see the same state and over-submit
+        lock = f"{prefix}autoscale.lock"
+        while not acquire_lock(lock, 300):
+            time.sleep(1)
+        with hold_lock(lock, 300):
+            pending, running = self.queue_state()
+            exit_markers = glob.glob(f"{glob.escape(prefix)}*.exit")
+            exiting_tasks = set(marker[len(prefix):-len(".exit")] for marker in exit_markers)
+            for marker in exit_markers:
+                if marker[len(prefix):-len(".exit")] not in running:
+                    os.remove(marker)
+            running = [task_id for task_id in running if task_id not in exiting_tasks]
+
+            n_needed = self.n_tasks_needed(self.trial_counts())
+            n_in_flight = len(pending) + len(running)
+
+            n_submitted = 0
+            n_cancelled = 0
+            if n_needed > n_in_flight:
+                n_submitted = n_needed - n_in_flight
+                self.study.record_job(self.storage, self.sbatch.submit(n_submitted, delay_minutes=delay_minutes))
+            elif n_needed < n_in_flight and len(pending) > 0:
+                # Only pending tasks are cancelled, starting from the last ones to be scheduled
+                to_cancel = pending[-min(n_in_flight - n_needed, len(pending)):]
+                subprocess.run([self.scancel_bin] + to_cancel, capture_output=True)
+                n_cancelled = len(to_cancel)
+
+        print(f"Autoscaler: {n_in_flight} tasks in flight, {n_needed} needed, "
+              f"{n_submitted} submitted, {n_cancelled} cancelled.")
+
+        return n_submitted, n_cancelled
@@ -0,0 +1,138 @@
+from typing import Dict, Optional
+from pathlib import Path
+import os
+import sys
+import shutil
+import contextlib
+
+import optuna
+
+CACHE_DIR = ".stune/cache"
+
+# Compilation cache events counted in this process (see _register_listener)
+_events = {"hits": 0, "misses": 0}
+_listening = False
+
+
+def _register_listener() -> bool:
+    # JAX reports persistent cache hits and misses through its monitoring events; it is only queried if imported
+    global _listening
+    if _listening is False and "jax" in sys.modules:
+        def listener(event: str, **kwargs) -> None:
+            if event == "/jax/compilation_cache/cache_hits":
+                _events["hits"] += 1
+            elif event == "/jax/compilation_cache/cache_misses":
+                _events["misses"] += 1
+
+        try:
+            sys.modules["jax"].monitoring.register_event_listener(listener)
+            _listening = True
+        except AttributeError:
+            pass
+
+    return _listening
+
+
+class CompilationCache:
+    """Study-scoped persistent (JAX/XLA) compilation cache, shared by all the trials and chained jobs of a study.
+
+    Configured in the study YAML as:
+
+        compilation_cache:
+            dir: .stune/cache           # shared or node-local (e.g., $TMPDIR) storage
+            max_size_gb: 10             # (optional) least recently used entries are evicted above this size
+            min_compile_time_secs: 0    # (optional) only cache programs that take longer to compile
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_size_gb: Optional[float] = None,
+        min_compile_time_secs: Optional[float] = None
+    ) -> None:
+        self.directory = directory
+        self.max_size_gb = max_size_gb
+        self.min_compile_time_secs = min_compile_time_secs
+
+    @staticmethod
+    def from_config(config, study_name: str) -> Optional["CompilationCache"]:
+        cache = config.get("compilation_cache", None)
+        if cache is None:
+            return None
+
+        return CompilationCache(
+            os.path.join(cache.get("dir", CACHE_DIR), study_name),
+            max_size_gb=cache.get("max_size_gb", None),
+            min_compile_time_secs=cache.get("min_compile_time_secs", None)
+        )
+
+    def env(self) -> Dict[str, str]:
+        env = {"JAX_COMPILATION_CACHE_DIR": self.directory}
+        if self.min_compile_time_secs is not None:
+            env["JAX_PERSISTENT_CACHE_MIN_COMPILE_TIME_SECS"] = str(self.min_compile_time_secs)
+
+        return env
+
+    def setup(self) -> None:
+        # Environment variables are read by JAX on import, so the config is also updated if it was already imported
+        env = {k: os.path.expandvars(v) for k, v in self.env().items()}
+        os.makedirs(env["JAX_COMPILATION_CACHE_DIR"], exist_ok=True)
+        os.environ.update(env)
+        if "jax" in sys.modules:
+            sys.modules["jax"].config.update("jax_compilation_cache_dir", env["JAX_COMPILATION_CACHE_DIR"])
+
+    def evict(self) -> int:
+        """Remove the least recently used entries until the cache fits max_size_gb, and return how many were removed."""
+        if self.max_size_gb is None:
+            return 0
+
+        entries = []
+        for path in Path(os.path.expandvars(self.directory)).rglob("*"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if path.is_file():
+                entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path))
+
+        size = sum(e[1] for e in entries)
+        max_size = self.max_size_gb * 2**30
+        n_removed = 0
+        for _, entry_size, path in sorted(entries):
+            if size <= max_size:
+                break
+            # Other workers may be evicting at the same time
+            with contextlib.suppress(FileNotFoundError):
+                path.unlink()
+                n_removed += 1
+            size -= entry_size
+
+        return n_removed
+
+    @contextlib.contextmanager
+    def track(self, trial: optuna.Trial):
+        # Hits and misses are counted through JAX monitoring events, or as new entries written if those are unavailable
+        directory = Path(os.path.expandvars(self.directory))
+        n_entries = sum(1 for _ in directory.rglob("*"))
+        listening = _register_listener()
+        hits, misses = _events["hits"], _events["misses"]
+        try:
+            yield
+        finally:
+            if listening is True:
+                trial.set_user_attr("cache/hits", _events["hits"] - hits)
+                trial.set_user_attr("cache/misses", _events["misses"] - misses)
+            else:
+                trial.set_user_attr("cache/misses", sum(1 for _ in directory.rglob("*")) - n_entries)
+
+
+def remove_cache(study_name: str) -> None:
+    # The cache location is read from the study config, if it still exists
+    directory = CACHE_DIR
+    config_name = f".stune/config/{study_name}.cfg"
+    if os.path.exists(config_name):
+        from omegaconf import OmegaConf
+
+        directory = OmegaConf.load(config_name).get("compilation_cache", {}).get("dir", CACHE_DIR)
+
+    shutil.rmtree(os.path.join(os.path.expandvars(directory), study_name), ignore_errors=True)
@@ -216,6 +216,7 @@ if __name__ == "__main__":
             "GPU_MEM_RESERVED": "0.1"
         }
 
+    get_env(env, "STUNE_STORAGE", True)
     get_env(env, "STUNE_USR", True)
     get_env(env, "STUNE_PWD")
     get_env(env, "STUNE_HOST", True)
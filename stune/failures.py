@@ -0,0 +1,210 @@
+from typing import Any, Dict, List, Optional, Tuple
+import math
+import hashlib
+import traceback
+import collections
+
+import optuna
+
+
+def fingerprint(e: BaseException) -> str:
+    # Exceptions raised by the same line of code share the fingerprint, regardless of their message
+    frames = traceback.extract_tb(e.__traceback__)
+    location = f"{frames[-1].filename}:{frames[-1].lineno}" if len(frames) > 0 else ""
+
+    return hashlib.md5(f"{type(e).__name__}@{location}".encode("utf-8")).hexdigest()[:12]
+
+
+def param_region(
+    params: Dict[str, Any],
+    distributions: Dict[str, optuna.distributions.BaseDistribution],
+    bins: int = 10
+) -> Dict[str, Any]:
+    # Continuous parameters are binned, so that close values belong to the same region
+    region = {}
+    for name, value in params.items():
+        distribution = distributions[name]
+        if isinstance(distribution, optuna.distributions.FloatDistribution):
+            low, high = distribution.low, distribution.high
+            if distribution.log:
+                low, high, value = math.log(low), math.log(high), math.log(value)
+            region[name] = min(bins - 1, int((value - low) / (high - low) * bins)) if high > low else 0
+        else:
+            region[name] = value
+
+    return region
+
+
+def region_key(region: Dict[str, Any]) -> str:
+    return hashlib.md5(repr(sorted(region.items())).encode("utf-8")).hexdigest()[:12]
+
+
+def in_region(trial: optuna.Trial, region: Dict[str, Any], bins: int = 10) -> bool:
+    # A region matches only once all its parameters have been sampled
+    if any(name not in trial.params for name in region):
+        return False
+
+    return param_region(
+        {name: trial.params[name] for name in region},
+        {name: trial.distributions[name] for name in region},
+        bins
+    ) == region
+
+
+class FailureBudget:
+    """Study-level failure budget, checked before resubmitting jobs.
+
+    Configured in the study YAML as (defaults shown):
+
+        failure_budget:
+            min_trials: 10                # trials needed before checking the failure rate
+            max_failure_rate: 0.9         # stop the study above this fraction of failed trials
+            max_consecutive_failures: 20  # stop the study after this many failures in a row (crash loop)
+            max_region_failures: 3        # blacklist a parameter region after this many failures (and no success)
+            region_bins: 10               # bins used to group continuous parameters into regions
+            backoff_minutes: 5            # delay of a resubmission after a job with only failures (doubled each time)
+            max_backoff_minutes: 240
+    """
+
+    def __init__(
+        self,
+        min_trials: int = 10,
+        max_failure_rate: float = 0.9,
+        max_consecutive_failures: int = 20,
+        max_region_failures: Optional[int] = 3,
+        region_bins: int = 10,
+        backoff_minutes: float = 5,
+        max_backoff_minutes: float = 240
+    ) -> None:
+        self.min_trials = min_trials
+        self.max_failure_rate = max_failure_rate
+        self.max_consecutive_failures = max_consecutive_failures
+        self.max_region_failures = max_region_failures
+        self.region_bins = region_bins
+        self.backoff_minutes = backoff_minutes
+        self.max_backoff_minutes = max_backoff_minutes
+
+    @staticmethod
+    def from_config(config) -> "FailureBudget":
+        return FailureBudget(**config.get("failure_budget", {}))
+
+    def report(self, study: optuna.Study) -> Dict[str, Any]:
+        trials = study.get_trials(
+            deepcopy=False,
+            states=[optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED, optuna.trial.TrialState.FAIL]
+        )
+        # Trials skipped because of the blacklist neither fail nor succeed
+        trials = [t for t in trials if not t.user_attrs.get("fail/blacklisted", False)]
+        trials = sorted(trials, key=lambda t: t.datetime_complete or t.datetime_start)
+        failed = [t for t in trials if t.state == optuna.trial.TrialState.FAIL]
+
+        n_consecutive = 0
+        for trial in reversed(trials):
+            if trial.state != optuna.trial.TrialState.FAIL:
+                break
+            n_consecutive += 1
+
+        fingerprints = collections.Counter(t.user_attrs.get("fail/fingerprint", "<unknown>") for t in failed)
+        messages = {
+            t.user_attrs.get("fail/fingerprint", "<unknown>"): t.user_attrs.get("fail/message", "") for t in failed
+        }
+
+        return {
+            "n_trials": len(trials),
+            "n_failed": len(failed),
+            "failure_rate": len(failed) / len(trials) if len(trials) > 0 else 0.0,
+            "n_consecutive_failures": n_consecutive,
+            "fingerprints": [(f, n, messages[f]) for f, n in fingerprints.most_common()],
+            "blacklist": self.blacklist(study)
+        }
+
+    def check(self, study: optuna.Study, n_completed: int, n_failed: int) -> Tuple[bool, float]:
+        """Return whether the study should be resubmitted and with which delay (in minutes).
+
+        n_completed and n_failed are the trials executed by the calling worker.
+        """
+        if self.stop(study) is not None:
+            return False, 0
+
+        # Back off exponentially while workers only fail, and reset as soon as a trial succeeds
+        backoff = study.user_attrs.get("failure/backoff", 0)
+        backoff = backoff + 1 if n_failed > 0 and n_completed == 0 else 0
+        study.set_user_attr("failure/backoff", backoff)
+
+        if backoff == 0:
+            return True, 0
+
+        return True, min(self.backoff_minutes * 2 ** (backoff - 1), self.max_backoff_minutes)
+
+    def stop(self, study: optuna.Study) -> Optional[str]:
+        """Record the reason in the study (so that all workers stop) and return it, if the budget is exhausted."""
+        if "failure/stopped" in study.user_attrs:
+            return study.user_attrs["failure/stopped"]
+
+        report = self.report(study)
+
+        reason = None
+        if report["n_trials"] >= self.min_trials and report["failure_rate"] > self.max_failure_rate:
+            reason = f"failure rate {report['failure_rate']:.2f} > {self.max_failure_rate}"
+        elif report["n_consecutive_failures"] >= self.max_consecutive_failures:
+            reason = f"{report['n_consecutive_failures']} consecutive failures"
+
+        if reason is not None:
+            study.set_user_attr("failure/stopped", reason)
+            print(self.format_report(report, f"Study stopped: {reason}."))
+
+        return reason
+
+    def update_blacklist(self, study: optuna.Study, trial: optuna.trial.FrozenTrial) -> None:
+        if self.max_region_failures is None or len(trial.params) == 0:
+            return
+
+        region = param_region(trial.params, trial.distributions, self.region_bins)
+        key = region_key(region)
+        if f"blacklist/{key}" in study.user_attrs:
+            return
+
+        n_failed = 0
+        states = [optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.FAIL]
+        for t in study.get_trials(deepcopy=False, states=states):
+            if set(t.params) != set(region) or param_region(t.params, t.distributions, self.region_bins) != region:
+                continue
+            if t.state == optuna.trial.TrialState.COMPLETE:
+                return
+            n_failed += 1
+
+        if n_failed >= self.max_region_failures:
+            study.set_user_attr(f"blacklist/{key}", region)
+
+    def blacklist(self, study: optuna.Study) -> List[Dict[str, Any]]:
+        return [v for k, v in study.user_attrs.items() if k.startswith("blacklist/")]
+
+    def is_blacklisted(self, trial: optuna.Trial, blacklist: List[Dict[str, Any]]) -> bool:
+        return any(in_region(trial, region, self.region_bins) for region in blacklist)
+
+    def format_report(self, report: Dict[str, Any], title: str = "Failure report") -> str:
+        lines = [
+            title,
+            f"Trials: {report['n_trials']}, failed: {report['n_failed']} ({report['failure_rate']:.0%}), "
+            f"consecutive failures: {report['n_consecutive_failures']}",
+            "Failures by fingerprint:"
+        ]
+        for f, n, message in report["fingerprints"]:
+            lines.append(f"  {f}  x{n}  {message}")
+        lines.append(f"Blacklisted regions: {len(report['blacklist'])}")
+        for region in report["blacklist"]:
+            lines.append(f"  {region}")
+
+        return "\n".join(lines)
+
+
+class FailureCallback:
+    def __init__(self, budget: FailureBudget) -> None:
+        self.budget = budget
+
+    def __call__(self, study: optuna.study.Study, trial: optuna.trial.FrozenTrial) -> None:
+        if trial.state == optuna.trial.TrialState.FAIL:
+            self.budget.update_blacklist(study, trial)
+            # A crash-looping study is stopped right away, rather than when the worker exits
+            if self.budget.stop(study) is not None:
+                study.stop()
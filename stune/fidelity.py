@@ -0,0 +1,120 @@
+from typing import Any, Callable, List, Optional
+import os
+import time
+
+import optuna
+
+from .slurm import SUBMIT_DIR, acquire_lock
+from .utils import Study, Storage
+
+
+class Fidelity:
+    """Asynchronous successive halving over separately scheduled rungs.
+
+    Configured in the study YAML as:
+
+        fidelity:
+            param: training/epochs      # config entry set to the budget of the rung
+            rungs: [1, 3, 9]            # budget of each rung
+            reduction_factor: 3         # only the top 1/reduction_factor trials of a rung are promoted
+            partitions: [short, short, long]  # (optional) partition of each rung
+
+    Rung 0 samples new configurations with short jobs, while each higher rung is a separate optuna study
+    ('<study>.rung<r>') whose workers re-run the promoted configurations with a larger budget, in jobs whose
+    length is scaled accordingly (minutes_per_trial refers to the largest budget). Configurations are promoted
+    (enqueued in the higher rung) by the workers of the rung below, right before they submit the higher rung's job.
+    """
+
+    def __init__(
+        self,
+        param: str,
+        rungs: List[float],
+        reduction_factor: int = 3,
+        partitions: Optional[List[str]] = None
+    ) -> None:
+        self.param = param
+        self.rungs = list(rungs)
+        self.reduction_factor = reduction_factor
+        self.partitions = list(partitions) if partitions is not None else None
+
+    @staticmethod
+    def from_config(config) -> Optional["Fidelity"]:
+        fidelity = config.get("fidelity", None)
+        if fidelity is None:
+            return None
+
+        return Fidelity(
+            param=fidelity["param"],
+            rungs=fidelity["rungs"],
+            reduction_factor=fidelity.get("reduction_factor", 3),
+            partitions=fidelity.get("partitions", None)
+        )
+
+    @property
+    def n_rungs(self) -> int:
+        return len(self.rungs)
+
+    def budget(self, rung: Optional[int]) -> float:
+        return self.rungs[rung or 0]
+
+    def partition(self, rung: Optional[int], default: Optional[str] = None) -> Optional[str]:
+        if self.partitions is None:
+            return default
+
+        return self.partitions[rung or 0]
+
+    def minutes_per_trial(self, rung: Optional[int], minutes_per_trial: float) -> float:
+        return minutes_per_trial * self.budget(rung) / self.rungs[-1]
+
+    def apply(self, config, rung: Optional[int]) -> None:
+        # Override the budget parameter in the config, so that RunInfo returns it like any other value
+        path = self.param.split("/")
+        node = config
+        for key in path[:-1]:
+            node = node[key]
+        node[path[-1]] = self.budget(rung)
+
+    def candidates(self, study: Study, storage: Storage, rung: int) -> List[optuna.trial.FrozenTrial]:
+        """Return the trials of rung-1 that can be promoted to rung and have not been yet."""
+        source = study.at_rung(rung - 1).get(storage)
+        target = study.at_rung(rung).get(storage)
+
+        completed = source.get_trials(deepcopy=False, states=[optuna.trial.TrialState.COMPLETE])
+        completed.sort(key=lambda t: t.value, reverse=source.direction == optuna.study.StudyDirection.MAXIMIZE)
+        top = completed[:len(completed) // self.reduction_factor]
+
+        promoted = set(t.user_attrs.get("source_trial", None) for t in target.get_trials(deepcopy=False))
+
+        return [t for t in top if t.number not in promoted]
+
+    def promote(self, study: Study, storage: Storage, rung: int, n_trials: int = 1) -> int:
+        """Enqueue up to n_trials promoted configurations in rung and return how many were enqueued."""
+        # Choosing and enqueueing must be atomic, otherwise concurrent workers would promote the same trials
+        os.makedirs(SUBMIT_DIR, exist_ok=True)
+        lock = os.path.join(SUBMIT_DIR, f"{study.name}.promote.lock")
+        while not acquire_lock(lock, 60):
+            time.sleep(0.1)
+        try:
+            candidates = self.candidates(study, storage, rung)[:n_trials]
+            target = study.at_rung(rung).get(storage)
+            for trial in candidates:
+                target.enqueue_trial(trial.params, user_attrs={"source_trial": trial.number, "rung": rung})
+        finally:
+            os.remove(lock)
+
+        return len(candidates)
+
+    def n_waiting(self, study: Study, storage: Storage, rung: int) -> int:
+        """Return how many promoted configurations of rung are still waiting to be run."""
+        target = study.at_rung(rung).get(storage)
+
+        return len(target.get_trials(deepcopy=False, states=[optuna.trial.TrialState.WAITING]))
+
+    @staticmethod
+    def promoted_only(trial: optuna.Trial, objective: Callable[[optuna.Trial], Any]) -> Any:
+        # Promoted configurations may be taken by other workers meanwhile, and then optuna would sample a new one
+        if "source_trial" not in trial.user_attrs:
+            trial.study.stop()
+            raise optuna.TrialPruned("No promoted configuration left in this rung")
+
+        return objective(trial)
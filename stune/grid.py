@@ -0,0 +1,137 @@
+from typing import Any, Dict, List, Optional, Tuple
+import os
+import itertools
+import threading
+
+import omegaconf
+import optuna
+
+from .slurm import SUBMIT_DIR, acquire_lock
+from .utils import Study, Storage
+
+# Claims not touched for this long belong to workers that were killed
+CLAIM_STALE_SECONDS = 300
+
+
+def grid_params(config, prefix: str = "") -> Dict[str, List[Any]]:
+    """Return the values of each sampled parameter of the config, keyed by its RunInfo path (e.g., 'hp/lr')."""
+    params = {}
+    for key, value in config.items():
+        if not isinstance(value, omegaconf.DictConfig):
+            continue
+
+        path = f"{prefix}{key}"
+        sample_type = value.get("sample_type", None)
+        if sample_type is None:
+            params.update(grid_params(value, f"{path}/"))
+        elif "grid" in value:
+            params[path] = list(value["grid"])
+        elif sample_type == "categorical":
+            params[path] = list(value["sample_space"])
+        elif sample_type == "range":
+            params[path] = list(range(value["sample_space"][0], value["sample_space"][1] + 1))
+        elif sample_type == "float":
+            raise NotImplementedError(f"Parameter {path} is continuous: list its grid values in a 'grid' entry")
+
+    return params
+
+
+def grid_points(config) -> List[Dict[str, Any]]:
+    # Cartesian product of all the parameters, in a deterministic order
+    params = grid_params(config)
+    names = sorted(params)
+
+    return [dict(zip(names, values)) for values in itertools.product(*(params[name] for name in names))]
+
+
+def worker_shard() -> Tuple[int, int]:
+    """Return the index of this worker and the number of workers, from the SLURM array task and rank."""
+    n_tasks = int(os.environ.get("SLURM_NTASKS", 1))
+    rank = int(os.environ.get("SLURM_PROCID", 0))
+    n_array_tasks = int(os.environ.get("SLURM_ARRAY_TASK_COUNT", 1))
+    array_task = int(os.environ.get("SLURM_ARRAY_TASK_ID", 1)) - int(os.environ.get("SLURM_ARRAY_TASK_MIN", 1))
+
+    return array_task * n_tasks + rank, n_array_tasks * n_tasks
+
+
+def claim_shard(study: Study, storage: Storage, config) -> Tuple[Optional[str], List[Tuple[int, Dict[str, Any]]]]:
+    """Claim a shard of the grid with points left to evaluate, and return its claim file and those (indexed) points.
+
+    The grid is split into the number of shards stored on the study by the scheduler ('grid/n_shards'), so slices
+    never change, whatever the size of the arrays resubmitted later. Each worker starts from the shard of its array
+    task and rank, and takes the next one whose claim file (held with slurm.hold_lock while the worker runs) is free.
+    The storage is read once here, rather than at every ask as BruteForceSampler does. Finished points are
+    recognised by the index recorded on their trials by GridShardSampler ('grid/index'), as the trials only hold
+    the parameters that the user module actually sampled.
+    """
+    optuna_study = study.get(storage)
+    index, count = worker_shard()
+    n_shards = optuna_study.user_attrs.get("grid/n_shards", count)
+    points = grid_points(config)
+
+    # Points started by a previous holder of the shard are run again, as it did not finish them
+    states = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)
+    done = set(
+        t.user_attrs["grid/index"] for t in optuna_study.get_trials(deepcopy=False, states=states)
+        if "grid/index" in t.user_attrs
+    )
+
+    claims_dir = os.path.join(SUBMIT_DIR, study.full_name, "grid")
+    os.makedirs(claims_dir, exist_ok=True)
+    for i in range(n_shards):
+        shard = (index + i) % n_shards
+        remaining = [(j, points[j]) for j in range(shard, len(points), n_shards) if j not in done]
+        claim = os.path.join(claims_dir, f"{shard}.claim")
+        if len(remaining) > 0 and acquire_lock(claim, CLAIM_STALE_SECONDS):
+            return claim, remaining
+
+    return None, []
+
+
+class GridShardSampler(optuna.samplers.BaseSampler):
+    """Assigns the given (indexed) grid points to the trials of this process, in order, without reading the storage."""
+
+    def __init__(self, points: List[Tuple[int, Dict[str, Any]]]) -> None:
+        self.points = list(points)
+        self.next_point = 0
+        self.assigned = {}
+        self.lock = threading.Lock()
+        self._fallback = optuna.samplers.RandomSampler()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("lock")
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @property
+    def remaining(self) -> int:
+        return len(self.points) - self.next_point
+
+    def infer_relative_search_space(self, study, trial):
+        return {}
+
+    def sample_relative(self, study, trial, search_space):
+        return {}
+
+    def before_trial(self, study: optuna.Study, trial: optuna.trial.FrozenTrial) -> None:
+        with self.lock:
+            if self.next_point >= len(self.points):
+                return
+            index, point = self.points[self.next_point]
+            self.assigned[trial._trial_id] = point
+            self.next_point += 1
+
+        study._storage.set_trial_user_attr(trial._trial_id, "grid/index", index)
+
+    def sample_independent(self, study, trial, param_name, param_distribution):
+        point = self.assigned.get(trial._trial_id, {})
+        if param_name in point:
+            return point[param_name]
+
+        # Parameters that are not part of the grid (or trials beyond it) are sampled randomly
+        return self._fallback.sample_independent(study, trial, param_name, param_distribution)
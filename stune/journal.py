@@ -0,0 +1,92 @@
+from typing import Any, Dict, Iterable, List
+import os
+import json
+import mmap
+import time
+import random
+
+try:
+    from optuna.storages.journal import BaseJournalBackend
+except ImportError:
+    # optuna < 4.0
+    from optuna.storages import BaseJournalLogStorage as BaseJournalBackend
+
+from .slurm import acquire_lock
+
+
+class FileJournal(BaseJournalBackend):
+    """Append-only journal file for optuna's JournalStorage, safe on shared file systems (NFS/Lustre).
+
+    Writers append whole batches of records under an O_EXCL lock file (atomic also on NFS, unlike flock), while
+    readers take no lock: they memory-map the file and only parse the records appended since their last read.
+    A record is only read once terminated by a newline, so a concurrent partial write is never parsed.
+
+    Unlike optuna's JournalFileBackend, a record torn by a writer killed mid-write does not make the journal
+    unreadable: the next writer terminates it and readers skip it (optuna's backend raises on every later read).
+    Only the offset of the next record is kept, rather than one offset per record read, and a lock left behind by a
+    crashed writer goes stale as the other locks of stune do (see slurm.acquire_lock).
+    """
+
+    def __init__(self, path: str, lock_timeout: float = 60) -> None:
+        self.path = path
+        self.lock_path = path + ".lock"
+        self.lock_timeout = lock_timeout
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        open(self.path, "ab").close()
+
+        # Number and byte offset of the next record to read, so that only new records are parsed
+        self._next_log_number = 0
+        self._next_offset = 0
+
+    def read_logs(self, log_number_from: int) -> Iterable[Dict[str, Any]]:
+        if log_number_from < self._next_log_number:
+            self._next_log_number, self._next_offset = 0, 0
+
+        logs = []
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= self._next_offset:
+                return logs
+
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+                offset = self._next_offset
+                while offset < size:
+                    end = data.find(b"\n", offset)
+                    if end == -1:
+                        break
+                    try:
+                        log = json.loads(data[offset:end])
+                    except ValueError:
+                        # Torn record of a crashed writer (terminated by the next one), skipped by all readers
+                        log = None
+                    if log is not None:
+                        if self._next_log_number >= log_number_from:
+                            logs.append(log)
+                        self._next_log_number += 1
+                    offset = end + 1
+                    self._next_offset = offset
+
+        return logs
+
+    def append_logs(self, logs: List[Dict[str, Any]]) -> None:
+        records = "".join(json.dumps(log, separators=(",", ":")) + "\n" for log in logs).encode("utf-8")
+
+        # Jittered exponential backoff, as each attempt is a metadata operation on the shared file system
+        delay = 0.001
+        while not acquire_lock(self.lock_path, self.lock_timeout):
+            time.sleep(delay + random.uniform(0, delay))
+            delay = min(delay * 2, 0.1)
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_APPEND)
+            try:
+                size = os.fstat(fd).st_size
+                if size > 0 and os.pread(fd, 1, size - 1) != b"\n":
+                    # The last writer was killed mid-record: terminate it, so that it is skipped as a whole
+                    records = b"\n" + records
+                os.write(fd, records)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        finally:
+            os.remove(self.lock_path)
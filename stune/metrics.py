@@ -0,0 +1,212 @@
+from typing import Any, Dict, List, Optional, Tuple
+from pathlib import Path
+import os
+import struct
+import shutil
+import tempfile
+import threading
+
+METRICS_DIR = ".stune/metrics"
+
+# Records of the append-only metrics file: a name definition is written the first time a metric is logged,
+# then each value only stores the id of its name
+_NAME = struct.Struct("<BIH")  # tag, name id, name length (followed by the utf-8 name)
+_VALUE = struct.Struct("<BIqd")  # tag, name id, step, value
+_NAME_TAG = 0
+_VALUE_TAG = 1
+
+
+class MetricsWriter:
+    """Buffered, append-only binary log of the metrics of a single trial.
+
+    Values are packed in memory by log() and written by a background thread in batches, so the training loop never
+    waits on the file system. The file (and the thread) are only created by the first log(), so trials that log
+    nothing leave nothing behind. The file lives on node-local disk while the trial runs and is moved to the
+    study's metrics folder when closed (see merge_metrics).
+    """
+
+    def __init__(
+        self,
+        path: str,
+        final_path: Optional[str] = None,
+        batch_size: int = 4096,
+        flush_seconds: float = 10
+    ) -> None:
+        self.path = path
+        self.final_path = final_path
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.names = {}
+        self.forwarders = []
+
+        self.file = None
+        self.thread = None
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.flush_event = threading.Event()
+        self.closed = False
+
+    def _open(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, "ab")
+        self.thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def for_trial(config, study_name: str, trial_number: int) -> "MetricsWriter":
+        local_dir = config.get("metrics_dir", None) or os.environ.get("TMPDIR", tempfile.gettempdir())
+
+        return MetricsWriter(
+            os.path.join(local_dir, "stune-metrics", study_name, f"{trial_number}.bin"),
+            final_path=os.path.join(METRICS_DIR, study_name, f"{trial_number}.bin")
+        )
+
+    def forward(self, forwarder: Any) -> None:
+        self.forwarders.append(forwarder)
+
+    def log(self, name: str, step: int, value: float) -> None:
+        with self.lock:
+            if self.file is None:
+                self._open()
+            if name not in self.names:
+                self.names[name] = len(self.names)
+                encoded = name.encode("utf-8")
+                self.buffer.append(_NAME.pack(_NAME_TAG, self.names[name], len(encoded)) + encoded)
+            self.buffer.append(_VALUE.pack(_VALUE_TAG, self.names[name], step, value))
+            n_buffered = len(self.buffer)
+
+        if n_buffered >= self.batch_size:
+            self.flush_event.set()
+
+        for forwarder in self.forwarders:
+            forwarder.log(name, step, value)
+
+    def flush(self) -> None:
+        with self.lock:
+            buffer, self.buffer = self.buffer, []
+        if len(buffer) > 0:
+            self.file.write(b"".join(buffer))
+            self.file.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+
+        self.closed = True
+        if self.file is None:
+            return
+
+        self.flush_event.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+
+        if self.final_path is not None:
+            # Copied under a temporary name and renamed, so that merge_metrics never reads a partial file
+            os.makedirs(os.path.dirname(self.final_path), exist_ok=True)
+            shutil.copyfile(self.path, self.final_path + ".tmp")
+            os.replace(self.final_path + ".tmp", self.final_path)
+            os.remove(self.path)
+
+    def _flush_loop(self) -> None:
+        while not self.closed:
+            self.flush_event.wait(self.flush_seconds)
+            self.flush_event.clear()
+            self.flush()
+
+    def __enter__(self) -> "MetricsWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class NeptuneForwarder:
+    # Forwards the logged metrics to a neptune run (see log.open_log)
+    def __init__(self, run) -> None:
+        self.run = run
+
+    def log(self, name: str, step: int, value: float) -> None:
+        self.run[name].append(value, step=step)
+
+
+def read_metrics(path: str) -> Tuple[List[str], List[Tuple[int, int, float]]]:
+    """Return the metric names and the (name id, step, value) records of a metrics file."""
+    with open(path, "rb") as f:
+        data = f.read()
+
+    names = {}
+    records = []
+    offset = 0
+    while offset < len(data):
+        # Truncated records (e.g., the trial was killed while writing) end the file
+        if data[offset] == _NAME_TAG:
+            if offset + _NAME.size > len(data):
+                break
+            _, name_id, length = _NAME.unpack_from(data, offset)
+            offset += _NAME.size
+            if offset + length > len(data):
+                break
+            names[name_id] = data[offset:offset + length].decode("utf-8")
+            offset += length
+        else:
+            if offset + _VALUE.size > len(data):
+                break
+            _, name_id, step, value = _VALUE.unpack_from(data, offset)
+            offset += _VALUE.size
+            records.append((name_id, step, value))
+
+    return [names[i] for i in range(len(names))], records
+
+
+def merge_metrics(study_name: str) -> Optional[str]:
+    """Merge the metrics files of a study into the columnar store '.stune/metrics/<study>.npz'.
+
+    The store holds the arrays 'trial', 'metric' (index into 'names'), 'step' and 'value'.
+    Merged files are removed, so the function can be called repeatedly while the study runs.
+    """
+    import numpy as np
+
+    store = os.path.join(METRICS_DIR, f"{study_name}.npz")
+    columns: Dict[str, List] = {"trial": [], "metric": [], "step": [], "value": []}
+    names: List[str] = []
+
+    if os.path.exists(store):
+        with np.load(store) as data:
+            names = list(data["names"])
+            for key in columns:
+                columns[key].append(data[key])
+
+    files = sorted(Path(METRICS_DIR, study_name).glob("*.bin"))
+    if len(files) == 0:
+        return store if os.path.exists(store) else None
+
+    name_ids = {name: i for i, name in enumerate(names)}
+    for file in files:
+        file_names, records = read_metrics(str(file))
+        if len(records) == 0:
+            continue
+        for name in file_names:
+            if name not in name_ids:
+                name_ids[name] = len(names)
+                names.append(name)
+        remap = np.array([name_ids[name] for name in file_names], dtype=np.int32)
+        file_records = np.array(records, dtype=np.float64)
+
+        columns["trial"].append(np.full(len(records), int(file.stem), dtype=np.int32))
+        columns["metric"].append(remap[file_records[:, 0].astype(np.int64)])
+        columns["step"].append(file_records[:, 1].astype(np.int64))
+        columns["value"].append(file_records[:, 2])
+
+    tmp = store + ".tmp.npz"
+    np.savez(
+        tmp,
+        names=np.array(names, dtype=str),
+        **{key: np.concatenate(value) if len(value) > 0 else np.array([]) for key, value in columns.items()}
+    )
+    os.replace(tmp, store)
+
+    for file in files:
+        file.unlink()
+
+    return store
@@ -0,0 +1,212 @@
+from typing import List, Optional, Tuple
+import os
+import random
+import hashlib
+import importlib
+import functools
+import contextlib
+
+from omegaconf import OmegaConf
+import optuna
+
+from .utils import Study, Storage
+from .slurm import Sbatch, cancel_pending, hold_lock
+from .grid import GridShardSampler, claim_shard, CLAIM_STALE_SECONDS
+from .failures import FailureBudget, FailureCallback
+from .stopping import StoppingRule, StoppingCallback
+from .tune import worker, query_partition_maxtime, CountExecutedTrialsCallback, TimeoutCallback
+
+
+def parse_studies(spec: str) -> List[Tuple[str, str, float]]:
+    # "<exec>.<study>[:<weight>],..." e.g. "mnist.lr_sweep:2,cifar.wd_sweep"
+    studies = []
+    for entry in spec.split(","):
+        name, _, weight = entry.strip().partition(":")
+        exec_name, _, study_name = name.partition(".")
+        if not study_name:
+            raise ValueError(f"Invalid study '{name}', expected '<exec>.<study>'")
+        studies.append((exec_name, study_name, float(weight or 1)))
+
+    return studies
+
+
+class MultiStudy:
+    """Weighted set of existing studies (from the same storage) sharing the same allocations.
+
+    Each study uses the config saved in .stune/config/ when it was created and the n_trials and sampler it was
+    scheduled with, so it must have been started at least once with `python -m stune <exec> --study <study>`.
+    """
+
+    def __init__(self, spec: str, storage: Storage) -> None:
+        self.spec = spec
+        self.storage = storage
+        self.studies = []
+        self.configs = []
+        self.weights = []
+
+        for exec_name, study_name, weight in parse_studies(spec):
+            attrs = optuna.load_study(study_name=f"{exec_name}.{study_name}", storage=storage.get()).user_attrs
+            study = Study(
+                exec_name=exec_name,
+                study_name=study_name,
+                sampler=attrs.get("sampler", None),
+                n_jobs=-1,
+                n_trials=attrs.get("n_trials", 0),
+                trials_per_worker=1
+            )
+            self.studies.append(study)
+            self.configs.append(OmegaConf.load(f".stune/config/{study.name}.cfg"))
+            self.weights.append(weight)
+
+        # Samplers of the grid-shard studies, holding the points of the shard claimed by this worker
+        self.grid_samplers = {}
+
+    def claim_grid(self, i: int, stack: contextlib.ExitStack) -> None:
+        # A grid-shard study claims a shard of its grid the first time it is picked, and holds it until the worker exits
+        study = self.studies[i]
+        if study.sampler != "grid-shard" or i in self.grid_samplers:
+            return
+
+        claim, points = claim_shard(study, self.storage, self.configs[i])
+        if claim is not None:
+            stack.enter_context(hold_lock(claim, CLAIM_STALE_SECONDS))
+        self.grid_samplers[i] = GridShardSampler(points)
+        study.set_sampler(self.grid_samplers[i])
+
+    @property
+    def job_name(self) -> str:
+        # Distinct for each group, otherwise the resubmissions of concurrent groups would be coalesced together
+        return f"stune-multi-{hashlib.md5(self.spec.encode('utf-8')).hexdigest()[:8]}"
+
+    def has_work(self, i: int, local: bool = False) -> bool:
+        """Return whether the study has trials left to run (with local=True, that this worker can run)."""
+        study = self.studies[i]
+        user_attrs = study.get(self.storage).user_attrs
+        if "stopping/reason" in user_attrs or "failure/stopped" in user_attrs:
+            return False
+        if local is True and i in self.grid_samplers:
+            return self.grid_samplers[i].remaining > 0
+        if study.n_trials == 0:
+            return True
+
+        states = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED, optuna.trial.TrialState.RUNNING)
+        return len(study.get(self.storage).get_trials(deepcopy=False, states=states)) < study.n_trials
+
+    def next(self, local: bool = False) -> Optional[int]:
+        candidates = [i for i in range(len(self.studies)) if self.has_work(i, local)]
+        if len(candidates) == 0:
+            return None
+
+        return random.choices(candidates, weights=[self.weights[i] for i in candidates])[0]
+
+
+def run_multi(
+    env,
+    spec: str,
+    storage: Storage,
+    partition: str,
+    n_jobs: int,
+    debug: bool = False
+):
+    multi = MultiStudy(spec, storage)
+
+    # The job geometry is taken from the first study, and the allocation is kept for the longest time allowed
+    config = multi.configs[0]
+    gpus_per_task = config.get("gpus_per_task", 1) if debug is False else 1
+    tasks_per_node = max(1, int(1 / gpus_per_task))
+    reserved_minutes = query_partition_maxtime(partition) - 1
+
+    cmd = f"python -m stune --multi {spec} --n_jobs -1 --partition {partition} "
+    cmd += storage.cmd_str()
+    if debug is True:
+        cmd += " --debug"
+
+    sbatch = Sbatch(
+        cmd,
+        tasks_per_node=tasks_per_node,
+        cpus_per_task=config.cpus_per_task,
+        gpu_reserved_memory=float(env["GPU_MEM_RESERVED"]),
+        time_minutes=reserved_minutes,
+        job_name=multi.job_name,
+        gpus=max(1, gpus_per_task),
+        partition=partition,
+        env=env["CONDA_ENV"],
+        ld_library_path=env["LD_LIBRARY_PATH"],
+        resources=config.get("resources", None)
+    )
+
+    # Worker
+    if n_jobs in [-1, 0]:
+        # JAX reads the location of its persistent cache once per process, so it cannot follow the studies
+        if any(config.get("compilation_cache", None) is not None for config in multi.configs):
+            print("Compilation caches are not used by co-scheduled studies.")
+
+        counter_callback = CountExecutedTrialsCallback()
+        timeout_callback = TimeoutCallback(reserved_minutes)
+        # Each study keeps its own failure budget, checked on the trials this worker ran for it
+        budgets = [FailureBudget.from_config(config) for config in multi.configs]
+        counters = [CountExecutedTrialsCallback() for _ in multi.studies]
+        # and its own stopping rules: a converged study records its reason, and is then skipped by has_work
+        study_callbacks = [[counters[i], FailureCallback(budgets[i])] for i in range(len(multi.studies))]
+        for i, config in enumerate(multi.configs):
+            stopping_rule = StoppingRule.from_config(config)
+            if stopping_rule is not None:
+                study_callbacks[i].append(StoppingCallback(stopping_rule))
+
+        # Pull one trial at a time from whichever study has work, until the reservation is over
+        with contextlib.ExitStack() as stack:
+            while timeout_callback.timed_out is False:
+                i = multi.next(local=True)
+                if i is None:
+                    break
+
+                multi.claim_grid(i, stack)
+                if not multi.has_work(i, local=True):
+                    continue
+
+                study = multi.studies[i]
+                study.get(storage).optimize(
+                    functools.partial(
+                        worker,
+                        study=study,
+                        exec=importlib.import_module(study.exec_name),
+                        params=multi.configs[i],
+                        track_cache=False
+                    ),
+                    n_trials=1,
+                    callbacks=[counter_callback, timeout_callback] + study_callbacks[i],
+                    catch=(Exception,),
+                    gc_after_trial=config.get("gc_after_trial", False)
+                )
+
+        for study in multi.studies:
+            storage.clear_stale_trials(study.name)
+
+        # Keep the allocations going while any of the studies has work left
+        if n_jobs == -1 and int(os.environ["SLURM_PROCID"]) == int(os.environ["SLURM_NTASKS"]) - 1:
+            # Crash-looping studies are stopped (and then skipped by has_work), and the resubmission is delayed
+            # while the studies run by this worker keep failing
+            delays = []
+            for i, study in enumerate(multi.studies):
+                if counters[i].n_trials > 0:
+                    can_resubmit, delay_minutes = budgets[i].check(
+                        study.get(storage), counters[i].n_trials_completed, counters[i].n_trials_failed
+                    )
+                    if can_resubmit:
+                        delays.append(delay_minutes)
+
+            if multi.next() is not None:
+                job_id = sbatch.submit(coalesce=True, delay_minutes=min(delays, default=0))
+                if job_id is not None:
+                    for study in multi.studies:
+                        study.record_job(storage, job_id)
+
+        # Once all the studies are complete, converged or stopped, the group frees the allocations left in the queue
+        if n_jobs == -1 and multi.next() is None:
+            cancel_pending(sbatch.job_name)
+
+    # Scheduler
+    else:
+        job_id = sbatch.submit(n_jobs)
+        for study in multi.studies:
+            study.record_job(storage, job_id)
@@ -0,0 +1,130 @@
+from typing import Any, Callable, Dict, List, Optional
+import os
+import time
+import pickle
+import queue
+import importlib
+import traceback
+import multiprocessing
+
+import optuna
+from omegaconf import OmegaConf
+
+from .utils import Study, Storage
+
+
+def _run_trial(
+    conn,
+    target: Callable,
+    study: Study,
+    storage_url: str,
+    trial_id: int,
+    config_name: str,
+    kwargs: Dict[str, Any],
+    env: Dict[str, str]
+):
+    # Environment variables (e.g., the GPU memory fraction) must be set before the backend is initialised
+    os.environ.update(env)
+
+    try:
+        # When forking, the study (and its sampler's random state) is inherited from the parent and must be reset
+        study._study = None
+        storage = Storage(storage_url)
+        # The exec module is preloaded by the forkserver (or inherited when forking), so this is a lookup
+        exec = importlib.import_module(study.exec_name)
+        optuna_study = study.get(storage)
+        if isinstance(optuna_study._storage, optuna.storages._CachedStorage):
+            # The cache of RDB storages only knows the trials created by this process
+            optuna_study._storage = optuna_study._storage._backend
+        trial = optuna.trial.Trial(optuna_study, trial_id)
+        result = ("value", target(trial, study=study, exec=exec, params=OmegaConf.load(config_name), **kwargs))
+    except BaseException as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError(traceback.format_exc())
+        result = ("error", e)
+
+    conn.send(result)
+    conn.close()
+
+
+class TrialPool:
+    """Runs each trial in a subprocess forked from a warm interpreter.
+
+    Trials are still asked and told by the parent's optuna loop (with n_jobs=n_slots threads),
+    so pruning, failures and callbacks behave as in the other parallelisation modes;
+    the subprocess only evaluates the objective, so a crash (e.g., segfault or OOM kill)
+    fails a single trial instead of the whole worker.
+    """
+
+    def __init__(
+        self,
+        n_slots: int,
+        start_method: str = "forkserver",
+        preload: Optional[List[str]] = None,
+        gpu_reserved_memory: float = 0.1,
+        timeout_minutes: Optional[float] = None
+    ) -> None:
+        self.context = multiprocessing.get_context(start_method)
+        if start_method == "forkserver":
+            self.context.set_forkserver_preload(["optuna", "omegaconf", "stune.tune"] + (preload or []))
+
+        self.n_slots = n_slots
+        self.timeout_minutes = timeout_minutes
+        self.gpu_mem_fraction = (1.0 - gpu_reserved_memory * n_slots) / n_slots
+        self.slots = queue.Queue()
+        for slot in range(n_slots):
+            self.slots.put(slot)
+
+    def slot_env(self, slot: int) -> Dict[str, str]:
+        return {
+            "STUNE_SLOT": str(slot),
+            "XLA_PYTHON_CLIENT_MEM_FRACTION": f"{self.gpu_mem_fraction:.2f}"
+        }
+
+    def run(
+        self,
+        trial: optuna.Trial,
+        target: Callable,
+        study: Study,
+        storage: Storage,
+        config_name: str,
+        **kwargs
+    ) -> Any:
+        slot = self.slots.get()
+        try:
+            recv_conn, send_conn = self.context.Pipe(duplex=False)
+            process = self.context.Process(
+                target=_run_trial,
+                args=(send_conn, target, study, storage.url, trial._trial_id, config_name, kwargs, self.slot_env(slot))
+            )
+            process.start()
+            send_conn.close()
+
+            # A subprocess that hangs (e.g., deadlocked after forking) is killed after timeout_minutes
+            deadline = time.monotonic() + self.timeout_minutes * 60 if self.timeout_minutes is not None else None
+            while not recv_conn.poll(1.0) and process.is_alive():
+                if deadline is not None and time.monotonic() > deadline:
+                    process.kill()
+                    break
+
+            try:
+                kind, result = recv_conn.recv()
+            except EOFError:
+                process.join()
+                kind, result = "error", RuntimeError(
+                    f"Trial {trial.number} crashed or timed out in slot {slot} (exit code {process.exitcode})"
+                )
+            recv_conn.close()
+            process.join()
+        finally:
+            self.slots.put(slot)
+
+        # The parameters and attributes were set by the subprocess: reload them for the parent's logs and callbacks
+        trial._cached_frozen_trial = trial.storage.get_trial(trial._trial_id)
+
+        if kind == "error":
+            raise result
+
+        return result
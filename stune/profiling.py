@@ -0,0 +1,102 @@
+from typing import Optional
+from pathlib import Path
+import io
+import os
+import random
+import threading
+import pstats
+import cProfile
+import contextlib
+import tracemalloc
+import collections
+
+PROFILES_DIR = ".stune/profiles"
+
+# Held by the trial being profiled, as the profilers are process-wide
+_profiler_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def profile_trial(mode: Optional[str], study_name: str, trial_number: int, fraction: float = 1.0):
+    """Profile the enclosed code and save the result to '.stune/profiles/<study>/<trial>.(prof|tracemalloc)'.
+
+    Only a fraction of the trials (chosen deterministically from their number) is profiled, to limit the overhead.
+    Both profilers are process-wide, so with the 'thread' parallelisation mode a trial is not profiled while another
+    one of the same process is (a second cProfile fails to enable on Python 3.12+, and stopping tracemalloc in one
+    trial would stop it for all of them).
+    """
+    if mode is None or random.Random(trial_number).random() >= fraction:
+        yield
+        return
+
+    if not _profiler_lock.acquire(blocking=False):
+        yield
+        return
+
+    try:
+        with _profile(mode, study_name, trial_number):
+            yield
+    finally:
+        _profiler_lock.release()
+
+
+@contextlib.contextmanager
+def _profile(mode: str, study_name: str, trial_number: int):
+    path = os.path.join(PROFILES_DIR, study_name, str(trial_number))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if mode == "cpu":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path + ".prof")
+    elif mode == "memory":
+        tracemalloc.start(16)
+        try:
+            yield
+        finally:
+            # The snapshot holds the memory still allocated at the end of the trial
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            snapshot.filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ]).dump(path + ".tracemalloc")
+    else:
+        raise NotImplementedError(f"Profile mode {mode} is not supported")
+
+
+def profile_report(study_name: str, top: int = 30) -> str:
+    """Merge the profiles of a study into a single table of hotspots, ranked by cumulative time (or size)."""
+    profiles_dir = Path(PROFILES_DIR, study_name)
+    cpu_profiles = sorted(str(p) for p in profiles_dir.glob("*.prof"))
+    memory_profiles = sorted(str(p) for p in profiles_dir.glob("*.tracemalloc"))
+
+    report = io.StringIO()
+    if len(cpu_profiles) > 0:
+        report.write(f"CPU hotspots of {study_name} ({len(cpu_profiles)} trials)\n")
+        stats = pstats.Stats(*cpu_profiles, stream=report)
+        stats.strip_dirs().sort_stats("cumulative").print_stats(top)
+
+    if len(memory_profiles) > 0:
+        sizes = collections.Counter()
+        counts = collections.Counter()
+        for profile in memory_profiles:
+            for stat in tracemalloc.Snapshot.load(profile).statistics("lineno"):
+                location = str(stat.traceback[0])
+                sizes[location] += stat.size
+                counts[location] += stat.count
+
+        report.write(f"Memory hotspots of {study_name} ({len(memory_profiles)} trials, memory retained per trial)\n")
+        report.write(f"{'size (KiB)'.rjust(12)} {'blocks'.rjust(10)}  location\n")
+        for location, size in sizes.most_common(top):
+            size_kib = size / len(memory_profiles) / 2**10
+            report.write(f"{size_kib:12.1f} {counts[location] // len(memory_profiles):10d}  {location}\n")
+
+    if report.tell() == 0:
+        report.write(f"No profiles found in {profiles_dir}\n")
+
+    return report.getvalue()
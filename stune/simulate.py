@@ -0,0 +1,344 @@
+from typing import Dict, List, Optional, Tuple
+import io
+import math
+import heapq
+import datetime
+import random
+import statistics
+
+import optuna
+
+from .slurm import reservation_minutes
+
+
+def load_trace(study: optuna.Study) -> List[Tuple[float, bool]]:
+    """Return the duration (in minutes) and the failure flag of the finished trials of a study."""
+    states = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED, optuna.trial.TrialState.FAIL)
+    trace = []
+    for trial in study.get_trials(deepcopy=False, states=states):
+        if trial.datetime_start is not None and trial.datetime_complete is not None:
+            minutes = (trial.datetime_complete - trial.datetime_start).total_seconds() / 60
+            trace.append((minutes, trial.state == optuna.trial.TrialState.FAIL))
+
+    return trace
+
+
+def estimate_startup_minutes(study: optuna.Study) -> Optional[float]:
+    """Median time between the start of a worker process and its first trial, from the worker/start attribute."""
+    first_trials = {}
+    for trial in study.get_trials(deepcopy=False):
+        if "worker/start" in trial.user_attrs and trial.datetime_start is not None:
+            start = trial.user_attrs["worker/start"]
+            first_trials[start] = min(first_trials.get(start, trial.datetime_start), trial.datetime_start)
+
+    startups = [
+        (first - datetime.datetime.fromisoformat(start)).total_seconds() / 60 for start, first in first_trials.items()
+    ]
+    startups = [minutes for minutes in startups if minutes >= 0]
+    if len(startups) == 0:
+        return None
+
+    return statistics.median(startups)
+
+
+class QueueWait:
+    """Time spent by a task in the queue: exponentially distributed (or fixed, if not stochastic) around a mean that
+    grows with the length of the reservation, as backfilling favours short jobs."""
+
+    def __init__(self, base_minutes: float = 10, minutes_per_reserved_hour: float = 0, stochastic: bool = True) -> None:
+        self.base_minutes = base_minutes
+        self.minutes_per_reserved_hour = minutes_per_reserved_hour
+        self.stochastic = stochastic
+
+    def sample(self, reserved_minutes: float, rng: random.Random) -> float:
+        mean = self.base_minutes + self.minutes_per_reserved_hour * reserved_minutes / 60
+        if self.stochastic is False or mean <= 0:
+            return max(0.0, mean)
+
+        return rng.expovariate(1 / mean)
+
+
+class Policy:
+    """The settings of `tune.run` that decide how a study is packed into SLURM tasks."""
+
+    def __init__(
+        self,
+        n_jobs: int,
+        trials_per_worker: int,
+        minutes_per_trial: float = 60,
+        tasks_per_node: int = 1,
+        gpus_per_task: float = 1,
+        max_concurrent: Optional[int] = None,
+        max_minutes: Optional[int] = None,
+        timeout_margin: int = 2,
+        autoscale: bool = False,
+        startup_minutes: float = 0,
+        backoff_minutes: float = 5,
+        max_backoff_minutes: float = 240
+    ) -> None:
+        self.n_jobs = n_jobs
+        self.trials_per_worker = trials_per_worker
+        self.minutes_per_trial = minutes_per_trial
+        self.tasks_per_node = tasks_per_node
+        self.gpus_per_task = gpus_per_task
+        self.max_concurrent = max_concurrent
+        self.max_minutes = max_minutes
+        self.timeout_margin = timeout_margin
+        self.autoscale = autoscale
+        self.startup_minutes = startup_minutes
+        self.backoff_minutes = backoff_minutes
+        self.max_backoff_minutes = max_backoff_minutes
+
+    @staticmethod
+    def from_config(config, **overrides) -> "Policy":
+        # Same defaults as tune.run (and FailureBudget)
+        gpus_per_task = config.get("gpus_per_task", 1)
+        failure_budget = config.get("failure_budget", {})
+        settings = {
+            "minutes_per_trial": config.get("minutes_per_trial", 60),
+            "tasks_per_node": max(1, int(1 / gpus_per_task)),
+            "gpus_per_task": gpus_per_task,
+            "max_concurrent": config.get("max_concurrent_jobs", None),
+            "timeout_margin": config.get("timeout_margin", 2),
+            "autoscale": config.get("autoscale", False),
+            "backoff_minutes": failure_budget.get("backoff_minutes", 5),
+            "max_backoff_minutes": failure_budget.get("max_backoff_minutes", 240)
+        }
+        settings.update(overrides)
+
+        return Policy(**settings)
+
+    @property
+    def reserved_minutes(self) -> int:
+        return reservation_minutes(self.minutes_per_trial, self.trials_per_worker, self.max_minutes)
+
+    @property
+    def gpus_per_allocation(self) -> int:
+        return max(1, round(self.gpus_per_task * self.tasks_per_node))
+
+
+def simulate(
+    trace: List[Tuple[float, bool]],
+    policy: Policy,
+    n_trials: int,
+    queue_wait: QueueWait,
+    seed: int = 0,
+    max_tasks: int = 100000
+) -> Dict[str, float]:
+    """Replay the worker and resubmission logic of `tune.run` in virtual time (minutes).
+
+    Trial durations and failures are drawn (with replacement) from the trace of a finished study. Each rank of a task
+    spends startup_minutes of its reservation on the interpreter, the imports and the storage setup, then runs up to
+    trials_per_worker trials, stops early as TimeoutCallback does, and is killed (losing its running trial) at the end
+    of the reservation. The last rank resubmits a task under the same conditions as the worker (delayed, as by the
+    failure budget, while whole workers fail); with autoscaling, enough tasks are kept in flight for the remaining
+    trials instead. The study ends once n_trials trials
+    have completed (failed trials do not count, as they are re-run by the next workers), or when no task is left,
+    e.g., because the last rank was killed before resubmitting: completed_trials then falls short of n_trials.
+    """
+    if not any(failed is False for _, failed in trace):
+        raise ValueError("The trace has no successful trials to replay")
+
+    rng = random.Random(seed)
+    reserved = policy.reserved_minutes
+    trials_per_task = policy.trials_per_worker * policy.tasks_per_node
+
+    events = []
+    counter = [0]
+
+    def push(time: float, kind: str, *payload):
+        heapq.heappush(events, (time, counter[0], kind, payload))
+        counter[0] += 1
+
+    stats = {"completed": 0, "failed": 0, "killed": 0, "running_trials": 0, "tasks": 0, "used": 0.0, "reserved": 0.0,
+             "unused_reservation": 0.0, "startup": 0.0, "failed_trials": 0.0, "backoff": 0}
+    pending = []  # Tasks out of the queue, waiting for a slot of the array (%max_concurrent)
+    running_tasks = set()
+    queued_tasks = [0]
+    makespan = 0.0
+
+    def submit(time: float, n: int):
+        for _ in range(n):
+            if stats["tasks"] >= max_tasks:
+                raise RuntimeError(f"Policy did not complete the study within {max_tasks} tasks")
+            stats["tasks"] += 1
+            queued_tasks[0] += 1
+            push(time + queue_wait.sample(reserved, rng), "eligible", stats["tasks"])
+
+    def start_task(time: float, task: int):
+        running_tasks.add(task)
+        ranks = [
+            {"task": task, "rank": rank, "start": time, "n": 0, "completed": 0, "failed": 0, "time_per_trial": 0.0,
+             "last": time, "timed_out": False, "done": False}
+            for rank in range(policy.tasks_per_node)
+        ]
+        stats["startup"] += min(policy.startup_minutes, reserved) * policy.gpus_per_allocation
+        for rank in ranks:
+            push(time + policy.startup_minutes, "ready", rank, ranks)
+
+    def start_trial(time: float, rank: Dict, ranks: List[Dict]):
+        if rank["n"] >= policy.trials_per_worker or stats["completed"] + stats["running_trials"] >= n_trials:
+            return exit_rank(time, rank, ranks)
+
+        minutes, failed = trace[rng.randrange(len(trace))]
+        stats["running_trials"] += 1
+        if time + minutes > rank["start"] + reserved:
+            # SLURM kills the task at the end of its reservation
+            push(max(time, rank["start"] + reserved), "kill", rank, ranks)
+        else:
+            push(time + minutes, "trial", rank, ranks, minutes, failed)
+
+    def kill_rank(time: float, rank: Dict, ranks: List[Dict]):
+        stats["running_trials"] -= 1
+        stats["killed"] += 1
+        exit_rank(time, rank, ranks, killed=True)
+
+    def end_trial(time: float, rank: Dict, ranks: List[Dict], minutes: float, failed: bool):
+        stats["running_trials"] -= 1
+        # The GPU time of failed trials is wasted, like the one of killed trials
+        stats["failed_trials" if failed else "used"] += minutes * policy.gpus_per_allocation / policy.tasks_per_node
+        stats["failed" if failed else "completed"] += 1
+        rank["failed" if failed else "completed"] += 1
+        rank["n"] += 1
+
+        # TimeoutCallback
+        rank["time_per_trial"] = max(rank["time_per_trial"], time - rank["last"])
+        rank["last"] = time
+        if time - rank["start"] + rank["time_per_trial"] * policy.timeout_margin > reserved:
+            rank["timed_out"] = True
+            return exit_rank(time, rank, ranks)
+
+        start_trial(time, rank, ranks)
+
+    def exit_rank(time: float, rank: Dict, ranks: List[Dict], killed: bool = False):
+        nonlocal makespan
+        rank["done"] = True
+        rank["end"] = time
+        makespan = max(makespan, time)
+
+        if all(r["done"] for r in ranks):
+            # The allocation is held until the last rank exits
+            running_tasks.discard(rank["task"])
+            duration = max(r["end"] for r in ranks) - ranks[0]["start"]
+            stats["reserved"] += duration * policy.gpus_per_allocation
+            stats["unused_reservation"] += (reserved - duration) * policy.gpus_per_allocation
+            if pending:
+                start_task(max(time, max(r["end"] for r in ranks)), pending.pop(0))
+
+        # A killed worker never reaches the resubmission logic
+        if killed or rank["rank"] != policy.tasks_per_node - 1 or stats["completed"] >= n_trials:
+            return
+
+        # FailureBudget.check
+        stats["backoff"] = stats["backoff"] + 1 if rank["failed"] > 0 and rank["completed"] == 0 else 0
+        delay = 0
+        if stats["backoff"] > 0:
+            delay = min(policy.backoff_minutes * 2 ** (stats["backoff"] - 1), policy.max_backoff_minutes)
+
+        if policy.autoscale:
+            in_flight = queued_tasks[0] + len(pending) + len(running_tasks)
+            if not all(r["done"] for r in ranks):
+                in_flight -= 1
+            remaining = n_trials - stats["completed"] - stats["running_trials"]
+            n_needed = math.ceil(max(0, remaining) / trials_per_task)
+            if policy.max_concurrent is not None:
+                n_needed = min(n_needed, policy.max_concurrent)
+            submit(time + delay, max(0, n_needed - in_flight))
+        elif rank["completed"] == policy.trials_per_worker or rank["failed"] != 0 or rank["timed_out"]:
+            submit(time + delay, 1)
+
+    # Scheduler
+    if policy.autoscale:
+        n_first = math.ceil(n_trials / trials_per_task)
+        submit(0.0, min(n_first, policy.max_concurrent or n_first))
+    else:
+        submit(0.0, policy.n_jobs)
+
+    while events:
+        time, _, kind, payload = heapq.heappop(events)
+        if kind == "eligible":
+            queued_tasks[0] -= 1
+            if policy.max_concurrent is not None and len(running_tasks) >= policy.max_concurrent:
+                pending.append(payload[0])
+            else:
+                start_task(time, payload[0])
+        elif kind == "ready":
+            start_trial(time, *payload)
+        elif kind == "kill":
+            kill_rank(time, *payload)
+        else:
+            end_trial(time, *payload)
+
+    return {
+        "makespan_hours": makespan / 60,
+        "reserved_gpu_hours": stats["reserved"] / 60,
+        "used_gpu_hours": stats["used"] / 60,
+        "utilization": stats["used"] / stats["reserved"] if stats["reserved"] > 0 else 0.0,
+        "wasted_gpu_hours": max(0.0, stats["reserved"] - stats["used"]) / 60,
+        "startup_gpu_hours": stats["startup"] / 60,
+        "failed_gpu_hours": stats["failed_trials"] / 60,
+        # Requested but released early: it does not cost GPU hours, but long reservations wait longer in the queue
+        "unused_reservation_hours": stats["unused_reservation"] / 60,
+        "tasks": stats["tasks"],
+        "killed_trials": stats["killed"],
+        "completed_trials": stats["completed"]
+    }
+
+
+def simulate_policies(
+    trace: List[Tuple[float, bool]],
+    policies: Dict[str, Policy],
+    n_trials: int,
+    queue_wait: QueueWait,
+    repeats: int = 10
+) -> str:
+    """Simulate each policy `repeats` times and return a table of the mean results."""
+    columns = [
+        "makespan_hours",
+        "reserved_gpu_hours",
+        "utilization",
+        "wasted_gpu_hours",
+        "startup_gpu_hours",
+        "failed_gpu_hours",
+        "unused_reservation_hours",
+        "tasks",
+        "killed_trials",
+        "completed_trials"
+    ]
+
+    report = io.StringIO()
+    report.write(f"Replay of {len(trace)} trials to complete {n_trials} trials ({repeats} runs per policy)\n")
+    startups = sorted({policy.startup_minutes for policy in policies.values()})
+    report.write(f"Startup of a task: {', '.join(f'{minutes:.1f}' for minutes in startups)} minutes\n")
+    report.write("policy".ljust(24) + "".join(column.rjust(26) for column in columns) + "\n")
+    for name, policy in policies.items():
+        results = [simulate(trace, policy, n_trials, queue_wait, seed=seed) for seed in range(repeats)]
+        row = [statistics.mean(r[column] for r in results) for column in columns]
+        report.write(str(name).ljust(24) + "".join(f"{value:26.2f}" for value in row) + "\n")
+
+    return report.getvalue()
+
+
+def simulate_study(study: optuna.Study, config, policies_config, max_minutes: Optional[int] = None) -> str:
+    """Simulate the policies of a YAML file on the trace of a finished study, e.g.:
+
+        n_trials: 500           # defaults to the n_trials of the study
+        repeats: 20
+        queue_wait: {base_minutes: 15, minutes_per_reserved_hour: 2}
+        startup_minutes: 3      # defaults to the startup measured on the workers of the study
+        policies:
+            short: {n_jobs: 16, trials_per_worker: 2}
+            long: {n_jobs: 4, trials_per_worker: 16, timeout_margin: 1}
+
+    The settings missing from a policy are read from the config of the study, as tune.run does.
+    """
+    trace = load_trace(study)
+    n_trials = policies_config.get("n_trials", study.user_attrs.get("n_trials", len(trace)))
+    queue_wait = QueueWait(**policies_config.get("queue_wait", {}))
+    startup_minutes = policies_config.get("startup_minutes", estimate_startup_minutes(study) or 0)
+    policies = {
+        name: Policy.from_config(config, **{"max_minutes": max_minutes, "startup_minutes": startup_minutes, **settings})
+        for name, settings in policies_config["policies"].items()
+    }
+
+    return simulate_policies(trace, policies, n_trials, queue_wait, policies_config.get("repeats", 10))
@@ -1,7 +1,87 @@
-from typing import Optional, List
+from typing import Dict, Optional, List
+from pathlib import Path
 import os
+import math
+import time
+import uuid
 import subprocess
 import random
+import threading
+import contextlib
+
+SUBMIT_DIR = ".stune/submit"
+
+# Errors returned by sbatch when the controller is busy or throttling submissions
+TRANSIENT_ERRORS = [
+    "Socket timed out",
+    "temporarily unavailable",
+    "Unable to contact slurm controller",
+    "Slurm temporarily unable",
+    "Resource temporarily unavailable",
+    "Zero Bytes were transmitted or received",
+    "Transaction limit",
+    "Try again"
+]
+
+
+def acquire_lock(lock: str, stale_seconds: float) -> bool:
+    # O_EXCL creation is atomic also on NFS (v3+), unlike flock
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+
+        return True
+    except FileExistsError:
+        # Remove locks left behind by crashed processes
+        try:
+            if time.time() - os.path.getmtime(lock) > stale_seconds:
+                os.remove(lock)
+        except FileNotFoundError:
+            pass
+
+        return False
+
+
+@contextlib.contextmanager
+def hold_lock(lock: str, stale_seconds: float):
+    """Keep an acquired lock fresh while the enclosed code runs (e.g., sbatch retries) and release it afterwards.
+
+    Other processes only take over locks that have not been touched for stale_seconds, i.e., whose holder crashed.
+    """
+    stop = threading.Event()
+
+    def touch():
+        while not stop.wait(stale_seconds / 4):
+            try:
+                os.utime(lock)
+            except FileNotFoundError:
+                return
+
+    thread = threading.Thread(target=touch, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        os.remove(lock)
+
+
+def cancel_pending(job_name: str, scancel_bin: str = "scancel") -> None:
+    # Cancel the tasks of the job that have not started yet, leaving the running ones to terminate by themselves
+    subprocess.run(
+        [scancel_bin, f"--name={job_name}", "--state=PENDING", f"--user={os.environ.get('USER', '')}"],
+        capture_output=True
+    )
+
+
+def reservation_minutes(minutes_per_trial: float, trials_per_worker: int, max_minutes: Optional[int] = None) -> int:
+    # Time for the worker's trials plus one, with a 20% margin, within the time limit of the partition
+    minutes = minutes_per_trial * (trials_per_worker + 1) * 1.2
+    if max_minutes is not None:
+        minutes = min(minutes, max_minutes - 1)
+
+    return int(minutes)
+
 
 class Sbatch:
     def __init__(
@@ -17,7 +97,12 @@ class Sbatch:
         output: Optional[str] = ".stune/output/%j-%x.out",
         env: Optional[str] = "base",
         ld_library_path: str = "",
-        resources: Optional[List[str]] = None
+        resources: Optional[List[str]] = None,
+        max_retries: int = 8,
+        coalesce_seconds: float = 10,
+        max_concurrent: Optional[int] = None,
+        sbatch_bin: str = "sbatch",
+        env_vars: Optional[Dict[str, str]] = None
     ):
         sbatch_cmd = "#!/bin/bash -l\n"
         sbatch_cmd += f"#SBATCH --nodes=1\n"
@@ -46,6 +131,11 @@ class Sbatch:
         sbatch_cmd += f"export XLA_PYTHON_CLIENT_PREALLOCATE=true\n"
         sbatch_cmd += f"export XLA_PYTHON_CLIENT_MEM_FRACTION=\".{int(100 * (1.0 - gpu_reserved_memory*tasks_per_node) / tasks_per_node)}\"\n"
 
+        # Additional environment variables (e.g., the compilation cache location), expanded by the shell
+        if env_vars is not None:
+            for key, value in env_vars.items():
+                sbatch_cmd += f"export {key}=\"{value}\"\n"
+
         # Copy over required dataset (TODO: should be changed to a set of requests made via the config file)
         if resources is not None:
             for resource in resources:
@@ -60,18 +150,94 @@ class Sbatch:
 
         self.job_name = job_name
         self.sbatch_cmd = sbatch_cmd
+        self.max_retries = max_retries
+        self.coalesce_seconds = coalesce_seconds
+        self.max_concurrent = max_concurrent
+        self.sbatch_bin = sbatch_bin
     
-    def submit(self, n_jobs: int = 1):
-        sbatch_filename = f"__sbatch_{self.job_name}_{random.randint(1, 1204)}.sh"
-        with open(".stune/" + sbatch_filename, "w") as f:
-            f.write(self.sbatch_cmd)
-        os.system(f"chmod +x .stune/{sbatch_filename}")
+    @property
+    def submit_dir(self) -> str:
+        # One folder per job name, as job names may be prefixes of each other (e.g., the rungs of a study)
+        return os.path.join(SUBMIT_DIR, self.job_name)
+
+    def submit(self, n_jobs: int = 1, coalesce: bool = False, delay_minutes: float = 0) -> Optional[str]:
+        """Submit the script as a job array of n_jobs tasks and return its job id.
+
+        The jobs are not started before delay_minutes (which, with coalesce=True, is the one of the submitting worker).
+
+        With coalesce=True, concurrent requests for the same job name (e.g., from all the workers resubmitting at the
+        end of their reservation) are merged into a single array submission. In this case None is returned by the
+        workers whose request was submitted by another one.
+        """
+        if coalesce is False:
+            return self._sbatch(n_jobs, delay_minutes)
+
+        os.makedirs(self.submit_dir, exist_ok=True)
+        request = os.path.join(self.submit_dir, f"{uuid.uuid4().hex}.req")
+        with open(request + ".tmp", "w") as f:
+            f.write(str(n_jobs))
+        os.rename(request + ".tmp", request)
+
+        lock = os.path.join(self.submit_dir, "submit.lock")
+        deadline = time.time() + self.coalesce_seconds * 10
+        while os.path.exists(request):
+            if acquire_lock(lock, self.coalesce_seconds * 5):
+                with hold_lock(lock, self.coalesce_seconds * 5):
+                    # Wait for the other workers to file their requests before claiming them all
+                    time.sleep(self.coalesce_seconds)
+
+                    return self._sbatch(self._claim_requests(), delay_minutes)
+            elif time.time() > deadline:
+                # The request was not picked up, so it is submitted directly (if it has not been claimed meanwhile)
+                try:
+                    os.remove(request)
+                except FileNotFoundError:
+                    return None
+
+                return self._sbatch(n_jobs, delay_minutes)
+
+            time.sleep(1)
+
+        return None
+
+    def _claim_requests(self) -> int:
+        n_jobs = 0
+        for request in Path(self.submit_dir).glob("*.req"):
+            try:
+                n_jobs += int(request.read_text())
+                request.unlink()
+            except (FileNotFoundError, ValueError):
+                pass
+
+        return n_jobs
+
+    def _sbatch(self, n_jobs: int, delay_minutes: float = 0) -> Optional[str]:
+        if n_jobs <= 0:
+            return None
 
         # Temporary fix for SLURM bug (see: https://bugs.schedmd.com/show_bug.cgi?id=14298)
         os.environ.pop("SLURM_CPU_BIND", None)
 
-        r = subprocess.run(["sbatch", f"--array=1-{n_jobs}", f".stune/{sbatch_filename}"])
-        
-        os.system(f"rm .stune/{sbatch_filename}")
+        array = f"1-{n_jobs}" + (f"%{self.max_concurrent}" if self.max_concurrent is not None else "")
+        options = [f"--begin=now+{int(math.ceil(delay_minutes))}minutes"] if delay_minutes > 0 else []
+
+        # The script is passed through stdin, so no file is written to disk
+        delay = 1
+        for attempt in range(self.max_retries + 1):
+            r = subprocess.run(
+                [self.sbatch_bin, "--parsable", f"--array={array}"] + options,
+                input=self.sbatch_cmd,
+                capture_output=True,
+                text=True
+            )
+
+            if r.returncode == 0:
+                return r.stdout.strip().split(";")[0]
+            elif attempt == self.max_retries or not any(e in r.stderr for e in TRANSIENT_ERRORS):
+                break
+
+            print(f"{self.sbatch_bin} failed ({r.stderr.strip()}), retrying in {delay}s...")
+            time.sleep(delay + random.uniform(0, delay))
+            delay = min(delay * 2, 300)
 
-        return r
\ No newline at end of file
+        raise RuntimeError(f"{self.sbatch_bin} failed with exit code {r.returncode}: {r.stderr.strip()}")
@@ -0,0 +1,119 @@
+from typing import Optional
+
+import optuna
+
+
+class StoppingRule:
+    """Convergence-based termination of a study.
+
+    Configured in the study YAML as (all rules are optional, the study stops as soon as one is met):
+
+        stopping:
+            min_trials: 20      # completed trials needed before checking any rule
+            patience: 50        # no improvement (larger than min_delta) of the best value in this many trials
+            min_delta: 0.0
+            target: 0.01        # the best value reached the target
+            regret_bound: 0.05  # the regret bound estimated by optuna's terminator is below this value
+    """
+
+    def __init__(
+        self,
+        min_trials: int = 20,
+        patience: Optional[int] = None,
+        min_delta: float = 0.0,
+        target: Optional[float] = None,
+        regret_bound: Optional[float] = None
+    ) -> None:
+        self.min_trials = min_trials
+        self.patience = patience
+        self.min_delta = min_delta
+        self.target = target
+        self.regret_bound = regret_bound
+        self._terminator = None
+
+    @staticmethod
+    def from_config(config) -> Optional["StoppingRule"]:
+        stopping = config.get("stopping", None)
+        if stopping is None:
+            return None
+
+        return StoppingRule(**stopping)
+
+    def reason(self, study: optuna.Study) -> Optional[str]:
+        """Return why the study should stop (or None), also if it was stopped by another worker."""
+        if "stopping/reason" in study.user_attrs:
+            return study.user_attrs["stopping/reason"]
+
+        trials = study.get_trials(deepcopy=False, states=[optuna.trial.TrialState.COMPLETE])
+        if len(trials) < self.min_trials:
+            return None
+
+        sign = 1 if study.direction == optuna.study.StudyDirection.MINIMIZE else -1
+        best = min(sign * t.value for t in trials)
+
+        if self.target is not None and best <= sign * self.target:
+            return f"target value {self.target} reached"
+
+        if self.patience is not None:
+            # Trials since the last improvement of the best value
+            best_so_far = float("inf")
+            last_improvement = 0
+            trials = sorted(trials, key=lambda t: t.number)
+            for i, trial in enumerate(trials):
+                if sign * trial.value < best_so_far - self.min_delta:
+                    best_so_far = sign * trial.value
+                    last_improvement = i
+            if len(trials) - 1 - last_improvement >= self.patience:
+                return f"no improvement in {self.patience} trials"
+
+        if self.regret_bound is not None:
+            regret_bound = self.regret_bound
+            terminator = self._make_terminator()
+            try:
+                if terminator is not None and terminator.should_terminate(study):
+                    return f"estimated regret below {regret_bound}"
+            except ImportError as e:
+                # Some dependencies are only imported when the regret is first estimated
+                self._disable_terminator(e)
+
+        return None
+
+    def _make_terminator(self):
+        # optuna's terminator has optional dependencies (e.g., torch), so it is only loaded if requested
+        if self._terminator is None:
+            try:
+                from optuna.terminator import Terminator, StaticErrorEvaluator
+
+                self._terminator = Terminator(
+                    error_evaluator=StaticErrorEvaluator(self.regret_bound),
+                    min_n_trials=self.min_trials
+                )
+            except ImportError as e:
+                self._disable_terminator(e)
+
+        return self._terminator
+
+    def _disable_terminator(self, e: ImportError) -> None:
+        print(f"Regret bound stopping rule disabled: {e}")
+        self.regret_bound = None
+        self._terminator = None
+
+    def stop(self, study: optuna.Study) -> Optional[str]:
+        """Record the reason in the study (so that all workers stop) and return it, if the study should stop."""
+        reason = self.reason(study)
+        if reason is not None and "stopping/reason" not in study.user_attrs:
+            study.set_user_attr("stopping/reason", reason)
+            print(f"Study {study.study_name} converged: {reason}.")
+
+        return reason
+
+
+class StoppingCallback:
+    def __init__(self, rule: StoppingRule) -> None:
+        self.rule = rule
+        self.stopped = False
+
+    def __call__(self, study: optuna.study.Study, trial: optuna.trial.FrozenTrial) -> None:
+        if self.rule.stop(study) is not None:
+            study.stop()
+            self.stopped = True
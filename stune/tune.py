@@ -1,7 +1,9 @@
 import os
+import math
 from typing import Any, Optional
 import importlib
 import functools
+import contextlib
 import subprocess
 import datetime
 
@@ -9,16 +11,36 @@ from omegaconf import OmegaConf
 import optuna
 
 from .utils import Study, Storage
-from .slurm import Sbatch
-from . import RunInfo #, open_log
+from .slurm import Sbatch, cancel_pending, reservation_minutes, hold_lock
+from .pool import TrialPool
+from .autoscale import Autoscaler
+from .fidelity import Fidelity
+from .failures import FailureBudget, FailureCallback, fingerprint
+from .watchdog import (
+    RecycleCallback, record_memory, reset_device_peak, restart_worker, pop_worker_state, process_start_time
+)
+from .metrics import MetricsWriter, NeptuneForwarder
+from .profiling import profile_trial
+from .cache import CompilationCache
+from .stopping import StoppingRule, StoppingCallback
+from .grid import GridShardSampler, claim_shard, CLAIM_STALE_SECONDS
+from .utils import RunInfo
 
 
 class TimeoutCallback:
-    def __init__(self, reserved_minutes: int|float) -> None:
+    def __init__(
+        self,
+        reserved_minutes: int|float,
+        start_time: Optional[datetime.datetime] = None,
+        margin: int = 2,
+        time_per_trial: float = 0
+    ) -> None:
         self.timeout = reserved_minutes * 60
-        self.time_per_trial = 0
-        self.start_time = datetime.datetime.now()
-        self.last_trial_time = self.start_time
+        self.margin = margin
+        self.time_per_trial = time_per_trial
+        self.start_time = start_time or datetime.datetime.now()
+        # A resumed worker (see restart_worker) starts timing its trials now, not from the start of the reservation
+        self.last_trial_time = datetime.datetime.now()
         self.timed_out = False
     
     def __call__(self, study: optuna.study.Study, trial: optuna.trial.FrozenTrial) -> None:
@@ -29,8 +51,8 @@ class TimeoutCallback:
         if last_trial_time > self.time_per_trial:
             self.time_per_trial = last_trial_time
 
-        # Check if running another trial would exceed the timeout (with a margin of 2 trials)
-        if (datetime.datetime.now() - self.start_time).seconds + self.time_per_trial * 2 > self.timeout:
+        # Check if running another trial would exceed the timeout (with a margin of 2 trials by default)
+        if (datetime.datetime.now() - self.start_time).seconds + self.time_per_trial * self.margin > self.timeout:
             study.stop()
             self.timed_out = True
         
@@ -38,12 +60,20 @@ class TimeoutCallback:
 
 
 class CountExecutedTrialsCallback:
-    def __init__(self) -> None:
-        self.n_trials_failed = 0
-        self.n_trials_completed = 0
+    def __init__(self, n_trials_completed: int = 0, n_trials_failed: int = 0, n_trials_skipped: int = 0) -> None:
+        self.n_trials_failed = n_trials_failed
+        self.n_trials_completed = n_trials_completed
+        # Trials pruned because their parameters are in a blacklisted region (see FailureBudget)
+        self.n_trials_skipped = n_trials_skipped
+
+    @property
+    def n_trials(self) -> int:
+        return self.n_trials_completed + self.n_trials_failed + self.n_trials_skipped
     
     def __call__(self, study: optuna.study.Study, trial: optuna.trial.FrozenTrial) -> None:
-        if trial.state in [optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED]:
+        if trial.state == optuna.trial.TrialState.PRUNED and trial.user_attrs.get("fail/blacklisted", False):
+            self.n_trials_skipped += 1
+        elif trial.state in [optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED]:
             self.n_trials_completed += 1
         elif trial.state == optuna.trial.TrialState.FAIL:
             self.n_trials_failed += 1
@@ -68,27 +98,68 @@ def query_partition_maxtime(partition: str) -> int:
     return max_minutes
 
 
+def record_worker_start(trial: optuna.Trial, objective: Any, worker_start: str) -> Any:
+    # Lets the simulator estimate the startup cost of a task (interpreter, imports, storage) from the trace
+    trial.set_user_attr("worker/start", worker_start)
+    return objective(trial)
+
+
 def worker(
     trial: Any,
     study: Study,
     exec: Any,
     params: OmegaConf,
-    log_mode: Optional[str] = None
+    log_mode: Optional[str] = None,
+    profile: Optional[str] = None,
+    profile_fraction: float = 1.0,
+    track_cache: bool = True
 ):
-    if log_mode is not None:
-        project_name = os.path.basename(os.path.dirname(os.path.realpath(exec.__file__))).lower()
-        # with open_log(
-        #     project_name,
-        #     study.exec_name,
-        #     mode=log_mode,
-        #     sweep_id=study.name,
-        #     level_tag="trial-level"
-        # ) as log:
-        #     run_info = RunInfo(params, study.name, trial, log)
-    else:
-        run_info = RunInfo(params, study.name, trial, None)
+    with contextlib.ExitStack() as stack:
+        # Metrics are buffered on node-local disk and, if a log mode is set, also forwarded to neptune
+        metrics = stack.enter_context(MetricsWriter.for_trial(params, study.full_name, trial.number))
+        if log_mode is not None:
+            from .log import open_log
+
+            project_name = os.path.basename(os.path.dirname(os.path.realpath(exec.__file__))).lower()
+            log = stack.enter_context(open_log(
+                project_name,
+                study.exec_name,
+                mode=log_mode,
+                sweep_id=study.name,
+                level_tag="trial-level",
+                custom_run_id=f"{study.full_name}.{trial.number}"
+            ))
+            metrics.forward(NeptuneForwarder(log))
 
-    return exec.main(run_info)
+        budget = FailureBudget.from_config(params)
+        run_info = RunInfo(
+            params, study.name, trial, None,
+            is_blacklisted=functools.partial(budget.is_blacklisted, blacklist=budget.blacklist(trial.study)),
+            metrics=metrics
+        )
+
+        fidelity = Fidelity.from_config(params)
+        if fidelity is not None:
+            fidelity.apply(params, study.rung)
+            trial.set_user_attr("budget", fidelity.budget(study.rung))
+
+        cache = CompilationCache.from_config(params, study.name)
+        if cache is not None and track_cache is True:
+            stack.enter_context(cache.track(trial))
+
+        reset_device_peak()
+        try:
+            with profile_trial(profile, study.full_name, trial.number, profile_fraction):
+                return exec.main(run_info)
+        except optuna.TrialPruned:
+            raise
+        except Exception as e:
+            # Fingerprints group the failures of the study by their origin (see FailureBudget.report)
+            trial.set_user_attr("fail/fingerprint", fingerprint(e))
+            trial.set_user_attr("fail/message", f"{type(e).__name__}: {e}"[:256])
+            raise
+        finally:
+            record_memory(trial)
 
 
 def run(
@@ -98,20 +169,35 @@ def run(
     config_name: str,
     debug: bool = False,
     log_level: Optional[str] = None,
-    description: Optional[str] = None
+    description: Optional[str] = None,
+    profile: Optional[str] = None,
+    profile_fraction: float = 1.0
 ):
-    parallelisation_mode = "process"
     config = OmegaConf.load(config_name)
+    parallelisation_mode = config.get("parallelisation_mode", "process")
+    if parallelisation_mode in ["fork", "forkserver"] and storage.url is None:
+        # Subprocesses cannot share an in-memory storage
+        print(f"Parallelisation mode '{parallelisation_mode}' requires a persistent storage, using 'process' instead.")
+        parallelisation_mode = "process"
+
+    # Multi-fidelity studies start from the lowest rung, with its own partition
+    fidelity = Fidelity.from_config(config)
+    if fidelity is not None and study.rung is None:
+        study = study.at_rung(0, fidelity.partition(0, study.partition))
+
+    # Compiled programs are reused across the trials, processes and chained jobs of the study
+    # (the cache directory may refer to node-local variables, e.g. $TMPDIR, so it is only touched by the workers)
+    cache = CompilationCache.from_config(config, study.name)
+    if cache is not None and (study.is_worker() or study.n_jobs == 0):
+        cache.setup()
 
     # Read config
     gpus_per_task = config.get("gpus_per_task", 1) if debug is False else 1
     tasks_per_node = max(1, int(1 / gpus_per_task))
     trials_per_worker = study.trials_per_worker # TODO: or max(1, study.n_trials // (study.n_jobs * tasks_per_node))
-    minutes_per_trials = config.get("minutes_per_trial", 60)
-    reserved_minutes = int(min(minutes_per_trials * (trials_per_worker + 1) * 1.2, query_partition_maxtime(study.partition) - 1))
 
-    if parallelisation_mode == "thread":
-        # Paarallelisation is handled by the worker
+    if parallelisation_mode in ["thread", "fork", "forkserver"]:
+        # Parallelisation is handled by the worker
         # so we reserve all cpus at once
         cpus_per_task = config.cpus_per_task * tasks_per_node
         n_processes = 1
@@ -121,27 +207,63 @@ def run(
         cpus_per_task = config.cpus_per_task
         n_processes = tasks_per_node
         jobs_per_process = 1
+    else:
+        raise NotImplementedError(f"Parallelisation mode {parallelisation_mode} is not supported")
     
-    # Define job to be (re-)submitted
-    cmd = f"python -m stune {study.exec_name} "
-    cmd += study.cmd_str()
-    cmd += storage.cmd_str()
-    if debug is True:
-        cmd += " --debug"
-    
-    sbatch = Sbatch(
-        cmd,
-        tasks_per_node=n_processes,
-        cpus_per_task=cpus_per_task,
-        gpu_reserved_memory=float(env["GPU_MEM_RESERVED"]),
-        time_minutes=reserved_minutes,
-        job_name=study.name, 
-        gpus=max(1, gpus_per_task),
-        partition=study.partition,
-        env=env["CONDA_ENV"],
-        ld_library_path=env["LD_LIBRARY_PATH"],
-        resources=config.get("resources", None)
-    )
+    def make_sbatch(study: Study):
+        # The job length is scaled to the budget of the rung for multi-fidelity studies
+        minutes_per_trials = config.get("minutes_per_trial", 60)
+        if fidelity is not None:
+            minutes_per_trials = fidelity.minutes_per_trial(study.rung, minutes_per_trials)
+        reserved_minutes = reservation_minutes(
+            minutes_per_trials, trials_per_worker, query_partition_maxtime(study.partition)
+        )
+
+        # Define job to be (re-)submitted
+        cmd = f"python -m stune {study.exec_name} "
+        cmd += study.cmd_str()
+        cmd += storage.cmd_str()
+        if debug is True:
+            cmd += " --debug"
+        if profile is not None:
+            cmd += f" --profile {profile} --profile-fraction {profile_fraction}"
+
+        sbatch = Sbatch(
+            cmd,
+            tasks_per_node=n_processes,
+            cpus_per_task=cpus_per_task,
+            gpu_reserved_memory=float(env["GPU_MEM_RESERVED"]),
+            time_minutes=reserved_minutes,
+            job_name=study.full_name,
+            gpus=max(1, gpus_per_task),
+            partition=study.partition,
+            env=env["CONDA_ENV"],
+            ld_library_path=env["LD_LIBRARY_PATH"],
+            resources=config.get("resources", None),
+            max_concurrent=config.get("max_concurrent_jobs", None),
+            env_vars=cache.env() if cache is not None else None
+        )
+
+        return sbatch, reserved_minutes
+
+    sbatch, reserved_minutes = make_sbatch(study)
+
+    # With autoscaling the size of the job array follows the remaining trials instead of n_jobs
+    autoscaler = None
+    if config.get("autoscale", False) is True and study.n_jobs != 0 and not study.rung:
+        if study.is_worker():
+            max_concurrent = study.get(storage).user_attrs.get("max_concurrent_jobs", None)
+        else:
+            max_concurrent = config.get("max_concurrent_jobs", study.n_jobs)
+            study.get(storage).set_user_attr("max_concurrent_jobs", max_concurrent)
+        autoscaler = Autoscaler(
+            study,
+            storage,
+            sbatch,
+            n_trials=study.n_trials,
+            trials_per_task=trials_per_worker * tasks_per_node,
+            max_concurrent=max_concurrent
+        )
 
     # Worker
     if study.is_worker() or study.n_jobs == 0:
@@ -150,29 +272,144 @@ def run(
         else:
             log_mode = None
                 
-        counter_callback = CountExecutedTrialsCallback()
-        timeout_callback = TimeoutCallback(reserved_minutes)
-        exec = importlib.import_module(study.exec_name)
-        study.get(storage).optimize(
-            functools.partial(
+        # A recycled worker resumes the counters and the reservation of the process it replaced
+        state = pop_worker_state()
+        counter_callback = CountExecutedTrialsCallback(
+            int(state.get("STUNE_TRIALS_COMPLETED", 0)),
+            int(state.get("STUNE_TRIALS_FAILED", 0)),
+            int(state.get("STUNE_TRIALS_SKIPPED", 0))
+        )
+        timeout_callback = TimeoutCallback(
+            reserved_minutes,
+            # The reservation started before the interpreter and the imports of this process
+            datetime.datetime.fromisoformat(state["STUNE_WORKER_START"]) if "STUNE_WORKER_START" in state
+            else process_start_time(),
+            margin=config.get("timeout_margin", 2),
+            time_per_trial=float(state.get("STUNE_TIME_PER_TRIAL", 0))
+        )
+        recycle_callback = RecycleCallback(config.get("max_trials_per_process", None), config.get("max_rss", None))
+        failure_budget = FailureBudget.from_config(config)
+        stopping_rule = StoppingRule.from_config(config)
+        callbacks = [counter_callback, timeout_callback, FailureCallback(failure_budget)]
+        if study.is_worker() and storage.url is not None:
+            # Only SLURM workers with a persistent storage are recycled: a local run would lose its in-memory storage
+            # and, without --study, its (generated) study name
+            callbacks.append(recycle_callback)
+        if stopping_rule is not None:
+            callbacks.append(StoppingCallback(stopping_rule))
+        if parallelisation_mode == "fork" and jobs_per_process > 1:
+            # Forking from optuna's threads can deadlock the children on locks held by the other threads
+            print("Parallelisation mode 'fork' with more than one job per process, using 'forkserver' instead.")
+            parallelisation_mode = "forkserver"
+        if parallelisation_mode in ["fork", "forkserver"]:
+            # The user module is imported once (by the forkserver or by this process) and each trial only costs a fork
+            if parallelisation_mode == "fork":
+                importlib.import_module(study.exec_name)
+            pool = TrialPool(
+                jobs_per_process,
+                start_method=parallelisation_mode,
+                preload=[study.exec_name],
+                gpu_reserved_memory=float(env["GPU_MEM_RESERVED"]),
+                timeout_minutes=config.get("trial_timeout_minutes", None)
+            )
+            objective = functools.partial(
+                pool.run,
+                target=worker,
+                study=study,
+                storage=storage,
+                config_name=config_name,
+                log_mode=log_mode,
+                profile=profile,
+                profile_fraction=profile_fraction
+            )
+        else:
+            exec = importlib.import_module(study.exec_name)
+            objective = functools.partial(
                 worker,
                 study=study,
                 exec=exec,
                 params=config,
                 log_mode=log_mode,
-            ),
-            n_trials=trials_per_worker,
-            n_jobs=jobs_per_process,
-            callbacks=[counter_callback, timeout_callback],
-            gc_after_trial=True
+                profile=profile,
+                profile_fraction=profile_fraction
+            )
+        objective = functools.partial(
+            record_worker_start, objective=objective, worker_start=timeout_callback.start_time.isoformat()
         )
-        storage.clear_stale_trials(study.name)
+        # Each parallel job runs trials_per_worker trials, as each process does in 'process' mode
+        trials_per_process = trials_per_worker * jobs_per_process
+        n_trials = trials_per_process - counter_callback.n_trials
+        if "failure/stopped" in study.get(storage).user_attrs:
+            # The study was stopped by its failure budget
+            n_trials = 0
+        elif stopping_rule is not None and stopping_rule.reason(study.get(storage)) is not None:
+            # The study has already converged
+            n_trials = 0
+        elif study.rung:
+            # Higher rungs only re-run the configurations promoted (enqueued) by the rung below before submitting them
+            n_trials = min(n_trials, fidelity.n_waiting(study, storage, study.rung))
+            objective = functools.partial(fidelity.promoted_only, objective=objective)
+        shard_claim = contextlib.nullcontext()
+        if n_trials > 0 and study.sampler == "grid-shard":
+            # Each worker evaluates a fixed slice of the grid (claimed for the duration of the optimisation),
+            # without querying the storage at each ask
+            claim, points = claim_shard(study, storage, config)
+            if claim is not None:
+                shard_claim = hold_lock(claim, CLAIM_STALE_SECONDS)
+            study.set_sampler(GridShardSampler(points[:n_trials]))
+            n_trials = min(n_trials, len(points))
+        with shard_claim:
+            study.get(storage).optimize(
+                objective,
+                n_trials=n_trials,
+                n_jobs=jobs_per_process,
+                callbacks=callbacks,
+                # Failed trials are counted (and checked against the failure budget) instead of ending the worker
+                catch=(Exception,),
+                gc_after_trial=config.get("gc_after_trial", False)
+            )
+
+        # Restart the process if it hit its memory or trial limits but still has trials to run
+        if (
+            recycle_callback.recycle is True
+            and timeout_callback.timed_out is False
+            and counter_callback.n_trials < trials_per_process
+        ):
+            restart_worker({
+                "STUNE_TRIALS_COMPLETED": str(counter_callback.n_trials_completed),
+                "STUNE_TRIALS_FAILED": str(counter_callback.n_trials_failed),
+                "STUNE_TRIALS_SKIPPED": str(counter_callback.n_trials_skipped),
+                "STUNE_WORKER_START": timeout_callback.start_time.isoformat(),
+                "STUNE_TIME_PER_TRIAL": str(timeout_callback.time_per_trial)
+            })
+
+        storage.clear_stale_trials(study.full_name)
+        if cache is not None:
+            cache.evict()
 
         # Once done check if study is complete,
         # if not, schedule another worker
-        if (
-            study.is_worker()
-            and int(os.environ["SLURM_PROCID"]) == int(os.environ["SLURM_NTASKS"]) - 1
+        is_last_rank = study.is_worker() and int(os.environ["SLURM_PROCID"]) == int(os.environ["SLURM_NTASKS"]) - 1
+        can_resubmit, delay_minutes = False, 0
+        if stopping_rule is not None and stopping_rule.stop(study.get(storage)) is not None:
+            # A converged study frees its allocations: no resubmission and no pending task left in the queue
+            if study.is_worker():
+                cancel_pending(sbatch.job_name)
+        elif is_last_rank:
+            # Stop (with a report) crash-looping studies, and delay resubmissions while they keep failing
+            can_resubmit, delay_minutes = failure_budget.check(
+                study.get(storage), counter_callback.n_trials_completed, counter_callback.n_trials_failed
+            )
+
+        resubmitted = False
+        if autoscaler is not None and can_resubmit:
+            autoscaler.step(
+                exiting=f"{os.environ['SLURM_ARRAY_JOB_ID']}_{os.environ['SLURM_ARRAY_TASK_ID']}",
+                delay_minutes=delay_minutes
+            )
+            resubmitted = True
+        elif (
+            can_resubmit
             and (
                 (
                     # TODO: redefine this behaviour
@@ -181,17 +418,48 @@ def run(
                 or study.n_trials == 0
             )
             and (
-                counter_callback.n_trials_completed == trials_per_worker
+                counter_callback.n_trials_completed + counter_callback.n_trials_skipped == trials_per_process
                 or counter_callback.n_trials_failed != 0
                 or timeout_callback.timed_out is True
             )
+            and (not study.rung or fidelity.n_waiting(study, storage, study.rung) > 0)
         ):
-            sbatch.submit()
+            job_id = sbatch.submit(coalesce=True, delay_minutes=delay_minutes)
+            if job_id is not None:
+                study.record_job(storage, job_id)
+            resubmitted = True
+
+        # Schedule the next rung of a multi-fidelity study once enough trials can be promoted to it
+        # (or once this rung is winding down and no other worker will check)
+        if fidelity is not None and can_resubmit and study.rung + 1 < fidelity.n_rungs:
+            n_candidates = len(fidelity.candidates(study, storage, study.rung + 1))
+            if n_candidates >= trials_per_worker * tasks_per_node or (n_candidates > 0 and resubmitted is False):
+                # Promoting before submitting (atomically) leaves no candidates to the other workers finishing now,
+                # so that a single job is submitted for each batch of promoted configurations
+                n_promoted = fidelity.promote(study, storage, study.rung + 1, n_candidates)
+                if n_promoted > 0:
+                    next_study = study.at_rung(study.rung + 1, fidelity.partition(study.rung + 1, study.partition))
+                    next_sbatch, _ = make_sbatch(next_study)
+                    n_tasks = math.ceil(n_promoted / (trials_per_worker * tasks_per_node))
+                    job_id = next_sbatch.submit(n_tasks, coalesce=True)
+                    if job_id is not None:
+                        next_study.record_job(storage, job_id)
 
     # Scheduler
     else:
-        storage.clear_stale_trials(study.name)
-        sbatch.submit(study.n_jobs)
+        storage.clear_stale_trials(study.full_name)
+
+        # Settings needed to run the study from other invocations (e.g., co-scheduled with --multi)
+        study.get(storage).set_user_attr("n_trials", study.n_trials)
+        study.get(storage).set_user_attr("sampler", study.sampler)
+        if study.sampler == "grid-shard" and "grid/n_shards" not in study.get(storage).user_attrs:
+            # The grid is split among the processes of the first array, and the slices are kept by later ones
+            study.get(storage).set_user_attr("grid/n_shards", max(1, study.n_jobs) * n_processes)
+
+        if autoscaler is not None:
+            autoscaler.step()
+        else:
+            study.record_job(storage, sbatch.submit(study.n_jobs))
 
         # if log_level in ["study", "all"] and debug is not True:
         #     import neptune.integrations.optuna as optuna_utils
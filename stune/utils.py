@@ -1,10 +1,13 @@
-from typing import Any, Optional, List
+from typing import TYPE_CHECKING, Any, Callable, Optional, List
 from pathlib import Path
+import os
 import datetime
 
-import optuna
-import omegaconf
-from omegaconf import OmegaConf
+# optuna and omegaconf are only needed when accessing the storage, creating configs and running trials,
+# so they are imported lazily (this module is imported by every `python -m stune` invocation)
+if TYPE_CHECKING:
+    import optuna
+    from omegaconf import OmegaConf
 
 
 class Storage:
@@ -16,11 +19,18 @@ class Storage:
     def init(args, env):
         url = args.storage
         if args.debug:
-            url = None
+            # Server-less storages can be shared by several local processes, so they are kept in debug mode
+            if url is None or not url.startswith(("file://", "sqlite://")):
+                url = None
         else:
             url = args.storage
             if url is None:
-                url = f"{env['STUNE_STORAGE']}://{env['STUNE_USR']}:{env['STUNE_PWD']}@{env['STUNE_HOST']}"
+                if env["STUNE_STORAGE"] == "file":
+                    url = f"file://{env.get('STUNE_HOST', None) or '.stune/journal.log'}"
+                elif env["STUNE_STORAGE"] == "sqlite":
+                    url = f"sqlite:///{env.get('STUNE_HOST', None) or '.stune/optuna.db'}"
+                else:
+                    url = f"{env['STUNE_STORAGE']}://{env['STUNE_USR']}:{env['STUNE_PWD']}@{env['STUNE_HOST']}"
 
         return Storage(url)
     
@@ -34,6 +44,8 @@ class Storage:
         return f" --storage {self.url} "
     
     def clear_stale_trials(self, study_name, timeeout_minutes=60):
+        import optuna
+
         try:
             study = optuna.study.load_study(study_name=study_name, storage=self.get())
             active_runs = study.get_trials(deepcopy=False, states=[optuna.trial.TrialState.RUNNING])
@@ -47,10 +59,35 @@ class Storage:
             pass
     
     def _make_storage(self):
+        import optuna
+
         if self.url is None:
             return optuna.storages.InMemoryStorage()
         elif self.url.startswith("redis://"):
-            return optuna.storages.JournalStorage(optuna.storages.JournalRedisStorage(url=self.url))
+            try:
+                from optuna.storages.journal import JournalRedisBackend
+            except ImportError:
+                # optuna < 4.0
+                from optuna.storages import JournalRedisStorage as JournalRedisBackend
+            return optuna.storages.JournalStorage(JournalRedisBackend(url=self.url))
+        elif self.url.startswith("file://"):
+            # Append-only journal on a shared file system, no server needed
+            from .journal import FileJournal
+            return optuna.storages.JournalStorage(FileJournal(self.url[len("file://"):]))
+        elif self.url.startswith("sqlite://"):
+            # Node-local database, WAL allows readers to proceed while a process writes
+            import sqlite3
+            path = self.url[len("sqlite:///"):]
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            with sqlite3.connect(path) as connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+            return optuna.storages.RDBStorage(
+                url=self.url,
+                engine_kwargs={"connect_args": {"timeout": 60}},
+                heartbeat_interval=60,
+                grace_period=120
+            )
         elif self.url.startswith("postgresql://"):
             return optuna.storages.RDBStorage(url=self.url, heartbeat_interval=60, grace_period=120)
         else:
@@ -62,6 +99,8 @@ def load_config(
         study: Optional[str] = None,
         config: Optional[str] = None
     ):
+    from omegaconf import OmegaConf
+
     def ensure_extension(path, extension, only_suffix: bool = True):
         if not str(path).endswith(extension):
             if only_suffix is True:
@@ -102,7 +141,8 @@ def load_config(
 
 
 class Study:
-    _study: optuna.Study = None
+    _study: "optuna.Study" = None
+    _sampler: Optional["optuna.samplers.BaseSampler"] = None
 
     def __init__(
         self,
@@ -114,6 +154,7 @@ class Study:
         n_trials: int = 1,
         trials_per_worker: Optional[int] = None,
         load_if_exists: bool = True,
+        rung: Optional[int] = None,
     ):
         self.exec_name = exec_name
         self.study_name = study_name
@@ -123,6 +164,7 @@ class Study:
         self.n_trials = n_trials
         self.trials_per_worker = trials_per_worker
         self.load_if_exists = load_if_exists
+        self.rung = rung
 
     @staticmethod
     def init(args, exec_name: str, study_name: Optional[str] = None, load_if_exists: bool = True):
@@ -140,18 +182,50 @@ class Study:
             n_jobs=args.n_jobs,
             n_trials=int(n_trials),
             trials_per_worker=int(trials_per_worker),
-            load_if_exists=load_if_exists
+            load_if_exists=load_if_exists,
+            rung=getattr(args, "rung", None)
         )
     
-    def get(self, storage: Storage) -> optuna.Study:
+    def get(self, storage: Storage) -> "optuna.Study":
         if self._study is None:
             self._study = self._make_study(storage)
         
         return self._study
+
+    def set_sampler(self, sampler: "optuna.samplers.BaseSampler"):
+        # Samplers that need the config (e.g., grid-shard) are created by the worker
+        self._sampler = sampler
+        if self._study is not None:
+            self._study.sampler = sampler
+
+    def __getstate__(self):
+        # The optuna study holds the storage connection, which cannot be shared with subprocesses
+        state = self.__dict__.copy()
+        state.pop("_study", None)
+
+        return state
     
     @property
     def name(self):
         return f"{self.exec_name}.{self.study_name}"
+
+    @property
+    def full_name(self):
+        # Each rung of a multi-fidelity study is stored as a separate optuna study
+        return self.name if not self.rung else f"{self.name}.rung{self.rung}"
+
+    def at_rung(self, rung: int, partition: Optional[str] = None) -> "Study":
+        return Study(
+            exec_name=self.exec_name,
+            study_name=self.study_name,
+            sampler=self.sampler,
+            partition=partition or self.partition,
+            n_jobs=self.n_jobs,
+            n_trials=self.n_trials,
+            trials_per_worker=self.trials_per_worker,
+            load_if_exists=self.load_if_exists,
+            rung=rung
+        )
     
     def cmd_str(self):
         cmd = f" --study {self.study_name} "
@@ -163,25 +237,35 @@ class Study:
             cmd += f"--n_jobs -1 "
         if self.n_trials is not None:
             cmd += f"--n_trials {self.n_trials}:{self.trials_per_worker} " # TODO
+        if self.rung is not None:
+            cmd += f"--rung {self.rung} "
         
         return cmd
 
+    def record_job(self, storage: Storage, job_id: str):
+        # One attribute per job avoids concurrent read-modify-write of a shared list
+        self.get(storage).set_user_attr(f"job/{job_id}", datetime.datetime.now().isoformat())
+
     def is_worker(self):
         return self.n_jobs == -1
 
     def _make_study(self, storage: Storage):
+        import optuna
+
         samplers = {
             None: lambda: None,
             "random": optuna.samplers.RandomSampler,
-            "grid": optuna.samplers.BruteForceSampler
+            "grid": optuna.samplers.BruteForceSampler,
+            # Replaced by a GridShardSampler on the points of each worker (see grid.py)
+            "grid-shard": optuna.samplers.RandomSampler
         }
 
         if self.sampler not in samplers:
             raise NotImplementedError(f"Sampler {self.sampler} is not supported")
-        sampler = samplers[self.sampler]()
+        sampler = self._sampler or samplers[self.sampler]()
 
         return optuna.create_study(
-            study_name=self.name,
+            study_name=self.full_name,
             storage=storage.get(),
             load_if_exists=self.load_if_exists,
             sampler=sampler
@@ -190,21 +274,28 @@ class Study:
 
 class RunInfo:
     def __init__(self,
-        config: OmegaConf,
+        config: "OmegaConf",
         study_name: str = None,
-        trial: Optional[optuna.Trial] = None,
-        log = None
+        trial: Optional["optuna.Trial"] = None,
+        log = None,
+        is_blacklisted: Optional[Callable[["optuna.Trial"], bool]] = None,
+        metrics = None
     ) -> None:
         self.config = config
         self.study_name = study_name
         self.trial = trial
         self.log = log or {}
         self.locked = False
-        
+        self.is_blacklisted = is_blacklisted
+        self.metrics = metrics
+
+        from omegaconf import OmegaConf
         OmegaConf.register_new_resolver("py", lambda code: eval(code.strip()), replace=True)
         OmegaConf.register_new_resolver("hp", lambda param: self[f"hp/{param}"], replace=True)
 
     def __getitem__(self, i: Any) -> Any:
+        import omegaconf
+
         if i in self.log:
             return self.log[i]
         
@@ -218,6 +309,13 @@ class RunInfo:
 
         if isinstance(param, omegaconf.DictConfig):
             param = self._sample_param(i, param, self.trial)
+
+            # Skip the trial as soon as its parameters fall in a region known to fail
+            if self.trial is not None and self.is_blacklisted is not None and self.is_blacklisted(self.trial):
+                import optuna
+
+                self.trial.set_user_attr("fail/blacklisted", True)
+                raise optuna.TrialPruned(f"Parameters {self.trial.params} are in a blacklisted region")
         
         self.log[i] = param
 
@@ -242,6 +340,11 @@ class RunInfo:
 
         self.locked = True
 
+    def log_metric(self, name: str, step: int, value: float) -> None:
+        # Does not block: values are buffered and written in batches (see metrics.MetricsWriter)
+        if self.metrics is not None:
+            self.metrics.log(name, int(step), float(value))
+
     @property
     def trial_id(self):
         return self.trial.number if self.trial is not None else None
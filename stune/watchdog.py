@@ -0,0 +1,116 @@
+from typing import Dict, Optional
+import os
+import datetime
+import sys
+import resource
+
+import optuna
+
+
+def process_rss_mb() -> float:
+    # Current resident set size of this process (falls back to the peak one if /proc is not available)
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def process_start_time() -> Optional[datetime.datetime]:
+    # Start of this process, i.e., before the interpreter and the imports (kept across restart_worker, which execs)
+    try:
+        with open("/proc/self/stat", "r") as f:
+            ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat", "r") as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None
+
+    return datetime.datetime.fromtimestamp(boot_time + ticks / os.sysconf("SC_CLK_TCK"))
+
+
+def device_memory_mb() -> Dict[str, float]:
+    # Only query the frameworks already imported by the user module, never import them here.
+    # device_mb is the memory in use at the end of the trial, device_peak_mb the peak since reset_device_peak (torch
+    # only, as the peak of jax cannot be reset and would only grow over the trials of the process).
+    if "jax" in sys.modules:
+        try:
+            stats = sys.modules["jax"].local_devices()[0].memory_stats()
+            if stats:
+                return {"device_mb": stats.get("bytes_in_use", 0) / 2**20}
+        except Exception:
+            pass
+    if "torch" in sys.modules:
+        try:
+            torch = sys.modules["torch"]
+            if torch.cuda.is_available():
+                return {
+                    "device_mb": torch.cuda.memory_allocated() / 2**20,
+                    "device_peak_mb": torch.cuda.max_memory_allocated() / 2**20
+                }
+        except Exception:
+            pass
+
+    return {}
+
+
+def reset_device_peak() -> None:
+    # Called at the start of each trial, so that the recorded peak belongs to the trial
+    if "torch" in sys.modules:
+        try:
+            torch = sys.modules["torch"]
+            if torch.cuda.is_available():
+                torch.cuda.reset_peak_memory_stats()
+        except Exception:
+            pass
+
+
+def record_memory(trial: optuna.Trial) -> None:
+    trial.set_user_attr("rss_mb", round(process_rss_mb(), 1))
+    for key, value in device_memory_mb().items():
+        trial.set_user_attr(key, round(value, 1))
+
+
+class RecycleCallback:
+    def __init__(self, max_trials_per_process: Optional[int] = None, max_rss: Optional[float] = None) -> None:
+        self.max_trials_per_process = max_trials_per_process
+        self.max_rss = max_rss
+        self.n_trials = 0
+        self.recycle = False
+
+    def __call__(self, study: optuna.study.Study, trial: optuna.trial.FrozenTrial) -> None:
+        self.n_trials += 1
+
+        # Stop the worker if it executed too many trials or it is leaking memory (max_rss is in MB).
+        # In fork/forkserver mode the trials run in subprocesses, so max_rss only bounds the worker process itself
+        # (the rss_mb recorded on each trial is the one of its subprocess).
+        if (
+            (self.max_trials_per_process is not None and self.n_trials >= self.max_trials_per_process)
+            or (self.max_rss is not None and process_rss_mb() > self.max_rss)
+        ):
+            study.stop()
+            self.recycle = True
+
+
+WORKER_STATE = [
+    "STUNE_TRIALS_COMPLETED",
+    "STUNE_TRIALS_FAILED",
+    "STUNE_TRIALS_SKIPPED",
+    "STUNE_WORKER_START",
+    "STUNE_TIME_PER_TRIAL"
+]
+
+
+def restart_worker(state: Dict[str, str]) -> None:
+    # Replace the current process with a fresh interpreter, keeping the same SLURM task (and thus reservation).
+    # The state is passed on through environment variables so that the new process can resume the worker.
+    os.environ.update(state)
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    os.execv(sys.executable, [sys.executable, "-m", "stune"] + sys.argv[1:])
+
+
+def pop_worker_state() -> Dict[str, str]:
+    # Removed from the environment, so that the jobs submitted by this process (which inherit it) start afresh
+    return {key: os.environ.pop(key) for key in list(os.environ) if key in WORKER_STATE}
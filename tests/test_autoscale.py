@@ -0,0 +1,118 @@
+import os
+import stat
+import time
+
+import optuna
+import pytest
+
+from stune.autoscale import Autoscaler
+from stune.slurm import Sbatch, acquire_lock, hold_lock
+from stune.utils import Storage, Study
+
+
+def fake_bin(path, script):
+    path.write_text("#!/bin/sh\n" + script)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+
+    return str(path)
+
+
+@pytest.fixture
+def slurm(tmp_path, monkeypatch):
+    """Fake squeue (listing queue.txt), sbatch and scancel (logging their arguments) in a temporary folder."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "queue.txt").write_text("")
+
+    return {
+        "squeue": fake_bin(tmp_path / "squeue", "cat queue.txt\n"),
+        "sbatch": fake_bin(tmp_path / "sbatch", "echo \"$@\" >> sbatch.log\necho 42\n"),
+        "scancel": fake_bin(tmp_path / "scancel", "echo \"$@\" >> scancel.log\n"),
+        "dir": tmp_path
+    }
+
+
+def make_autoscaler(slurm, n_finished: int, n_trials: int = 10, max_concurrent: int = 4):
+    storage = Storage(None)
+    study = Study("mod", "study", sampler="random", n_jobs=-1)
+    for _ in range(n_finished):
+        study.get(storage).add_trial(optuna.trial.create_trial(value=0.0))
+
+    sbatch = Sbatch("echo", job_name=study.full_name, env=None, sbatch_bin=slurm["sbatch"])
+
+    return Autoscaler(
+        study,
+        storage,
+        sbatch,
+        n_trials=n_trials,
+        trials_per_task=2,
+        max_concurrent=max_concurrent,
+        squeue_bin=slurm["squeue"],
+        scancel_bin=slurm["scancel"]
+    )
+
+
+def log(slurm, name):
+    path = slurm["dir"] / f"{name}.log"
+
+    return path.read_text().splitlines() if path.exists() else []
+
+
+def test_submits_tasks_up_to_max_concurrent(slurm):
+    autoscaler = make_autoscaler(slurm, n_finished=0)
+
+    assert autoscaler.step() == (4, 0)
+    assert log(slurm, "sbatch") == ["--parsable --array=1-4"]
+
+
+def test_submits_only_missing_tasks(slurm):
+    (slurm["dir"] / "queue.txt").write_text("7_1 RUNNING\n7_2 PENDING\n")
+    autoscaler = make_autoscaler(slurm, n_finished=4)
+
+    # 6 trials left, i.e., 3 tasks of 2 trials, and 2 tasks in flight
+    assert autoscaler.step() == (1, 0)
+    assert log(slurm, "sbatch") == ["--parsable --array=1-1"]
+
+
+def test_cancels_surplus_pending_tasks(slurm):
+    (slurm["dir"] / "queue.txt").write_text("7_1 RUNNING\n7_2 PENDING\n7_3 PENDING\n7_4 PENDING\n")
+    autoscaler = make_autoscaler(slurm, n_finished=8)
+
+    # 2 trials left, i.e., 1 task, so the last 3 pending tasks are cancelled
+    assert autoscaler.step() == (0, 3)
+    assert log(slurm, "scancel") == ["7_2 7_3 7_4"]
+    assert log(slurm, "sbatch") == []
+
+
+def test_exiting_task_is_not_in_flight(slurm):
+    (slurm["dir"] / "queue.txt").write_text("7_1 RUNNING\n7_2 RUNNING\n")
+    autoscaler = make_autoscaler(slurm, n_finished=6)
+
+    # 4 trials left (2 tasks): 7_1 is exiting, so one task replaces it
+    assert autoscaler.step(exiting="7_1") == (1, 0)
+    assert os.path.exists(os.path.join(autoscaler.sbatch.submit_dir, "7_1.exit"))
+
+
+def test_submissions_are_delayed_by_the_backoff(slurm):
+    autoscaler = make_autoscaler(slurm, n_finished=8)
+
+    assert autoscaler.step(exiting="7_1", delay_minutes=10) == (1, 0)
+    assert log(slurm, "sbatch") == ["--parsable --array=1-1 --begin=now+10minutes"]
+
+
+def test_completed_study_submits_nothing(slurm):
+    autoscaler = make_autoscaler(slurm, n_finished=10)
+
+    assert autoscaler.step() == (0, 0)
+    assert log(slurm, "sbatch") == []
+
+
+def test_held_lock_does_not_go_stale(tmp_path):
+    lock = str(tmp_path / "test.lock")
+    assert acquire_lock(lock, 0.4)
+
+    with hold_lock(lock, 0.4):
+        time.sleep(1.0)
+        # The holder keeps touching the lock, so it is not taken over
+        assert acquire_lock(lock, 0.4) is False
+
+    assert not os.path.exists(lock)
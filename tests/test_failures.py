@@ -0,0 +1,75 @@
+import os
+import stat
+
+import optuna
+import pytest
+
+from stune import tune
+from stune.utils import Storage, Study
+
+
+def fake_bin(path, script):
+    path.write_text("#!/bin/sh\n" + script)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+
+    return str(path)
+
+
+@pytest.fixture
+def worker_env(tmp_path, monkeypatch):
+    """The last rank of a SLURM array task, with fake sinfo and sbatch (logging their arguments) on the PATH."""
+    monkeypatch.chdir(tmp_path)
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    fake_bin(bin_dir / "sinfo", "echo TIMELIMIT\necho 1-00:00:00\n")
+    fake_bin(bin_dir / "sbatch", "echo \"$@\" >> sbatch.log\necho 42\n")
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    for key, value in {
+        "SLURM_PROCID": "0", "SLURM_NTASKS": "1", "SLURM_ARRAY_JOB_ID": "7", "SLURM_ARRAY_TASK_ID": "1"
+    }.items():
+        monkeypatch.setenv(key, value)
+
+    # The user module: every trial crashes on the same line
+    (tmp_path / "crashing_exec.py").write_text("def main(run_info):\n    raise ValueError('diverged')\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    return tmp_path
+
+
+def run_worker(tmp_path, storage, failure_budget):
+    config = tmp_path / "study.cfg"
+    config.write_text(f"cpus_per_task: 1\nminutes_per_trial: 60\nfailure_budget: {failure_budget}\n")
+    study = Study("crashing_exec", "study", sampler="random", partition="small", n_jobs=-1, n_trials=20,
+                  trials_per_worker=5)
+    env = {"GPU_MEM_RESERVED": "0.1", "CONDA_ENV": None, "LD_LIBRARY_PATH": ""}
+
+    tune.run(env, study, storage, str(config))
+
+    return study.get(storage)
+
+
+def sbatch_log(tmp_path):
+    path = tmp_path / "sbatch.log"
+
+    return path.read_text().splitlines() if path.exists() else []
+
+
+def test_crash_loop_is_stopped_by_the_budget(worker_env):
+    study = run_worker(worker_env, Storage(None), "{max_consecutive_failures: 3}")
+
+    # The worker survives the exceptions, and stops the study as soon as the budget is exhausted
+    trials = study.get_trials(deepcopy=False)
+    assert len(trials) == 3
+    assert all(t.state == optuna.trial.TrialState.FAIL for t in trials)
+    assert len(set(t.user_attrs["fail/fingerprint"] for t in trials)) == 1
+    assert study.user_attrs["failure/stopped"] == "3 consecutive failures"
+    assert sbatch_log(worker_env) == []
+
+
+def test_failing_worker_is_resubmitted_with_backoff(worker_env):
+    study = run_worker(worker_env, Storage(None), "{max_consecutive_failures: 100, max_failure_rate: 1.0}")
+
+    assert "failure/stopped" not in study.user_attrs
+    assert study.user_attrs["failure/backoff"] == 1
+    assert len(sbatch_log(worker_env)) == 1
+    assert "--begin=now+5minutes" in sbatch_log(worker_env)[0]
@@ -0,0 +1,69 @@
+import os
+
+import pytest
+from omegaconf import OmegaConf
+
+from stune.grid import GridShardSampler, claim_shard
+from stune.utils import Storage, Study
+
+
+@pytest.fixture
+def grid_study(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for key, value in {"SLURM_NTASKS": "1", "SLURM_PROCID": "0", "SLURM_ARRAY_TASK_ID": "1"}.items():
+        monkeypatch.setenv(key, value)
+
+    storage = Storage(None)
+    study = Study("mod", "grid", sampler="grid-shard", n_jobs=-1)
+    study.get(storage).set_user_attr("grid/n_shards", 2)
+    config = OmegaConf.create({
+        "hp": {
+            "lr": {"sample_type": "categorical", "sample_space": [0.1, 0.01, 0.001]},
+            "wd": {"sample_type": "categorical", "sample_space": [0.0, 0.1]}
+        }
+    })
+
+    return study, storage, config
+
+
+def run_shard(study, storage, config, objective):
+    claim, points = claim_shard(study, storage, config)
+    if claim is None:
+        return 0
+
+    study.set_sampler(GridShardSampler(points))
+    study.get(storage).optimize(objective, n_trials=len(points))
+
+    return len(points)
+
+
+def test_shards_cover_the_grid_once(grid_study):
+    study, storage, config = grid_study
+
+    def objective(trial):
+        return trial.suggest_float("hp/lr", 0.001, 0.1) + trial.suggest_float("hp/wd", 0.0, 0.1)
+
+    # Claims are released by the workers holding them (see tune.run), here they are simply left behind
+    assert run_shard(study, storage, config, objective) == 3
+    assert run_shard(study, storage, config, objective) == 3
+
+    params = [tuple(sorted(t.params.items())) for t in study.get(storage).trials]
+    assert len(set(params)) == 6
+
+
+def test_unread_parameters_do_not_rerun_points(grid_study, tmp_path):
+    study, storage, config = grid_study
+
+    # The user module only reads hp/lr, e.g., because hp/wd is conditional
+    assert run_shard(study, storage, config, lambda trial: trial.suggest_float("hp/lr", 0.001, 0.1)) == 3
+    for claim in (tmp_path / ".stune").rglob("*.claim"):
+        claim.unlink()
+
+    # The first shard is done, so the next worker takes the other one, and then nothing is left
+    claim, points = claim_shard(study, storage, config)
+    assert claim.endswith("1.claim")
+    assert [index for index, _ in points] == [1, 3, 5]
+    study.set_sampler(GridShardSampler(points))
+    study.get(storage).optimize(lambda trial: trial.suggest_float("hp/lr", 0.001, 0.1), n_trials=len(points))
+    os.remove(claim)
+    assert claim_shard(study, storage, config) == (None, [])
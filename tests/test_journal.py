@@ -0,0 +1,77 @@
+import multiprocessing
+
+import optuna
+
+from stune.journal import FileJournal
+
+N_WRITERS = 4
+N_BATCHES = 50
+
+
+def write_batches(path, writer):
+    journal = FileJournal(path)
+    for batch in range(N_BATCHES):
+        journal.append_logs([{"writer": writer, "batch": batch, "i": i} for i in range(3)])
+
+
+def test_concurrent_writers(tmp_path):
+    path = str(tmp_path / "journal.log")
+    reader = FileJournal(path)
+
+    processes = [
+        multiprocessing.get_context("spawn").Process(target=write_batches, args=(path, writer))
+        for writer in range(N_WRITERS)
+    ]
+    for process in processes:
+        process.start()
+    # Read while the others write: partial records must never be parsed
+    logs = []
+    while any(process.is_alive() for process in processes):
+        logs += reader.read_logs(len(logs))
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    logs += reader.read_logs(len(logs))
+
+    assert len(logs) == N_WRITERS * N_BATCHES * 3
+    assert logs == FileJournal(path).read_logs(0)
+    for writer in range(N_WRITERS):
+        # The batches of each writer are appended whole and in order
+        records = [(log["batch"], log["i"]) for log in logs if log["writer"] == writer]
+        assert records == [(batch, i) for batch in range(N_BATCHES) for i in range(3)]
+
+
+def test_torn_record_is_skipped(tmp_path):
+    path = str(tmp_path / "journal.log")
+    journal = FileJournal(path)
+    journal.append_logs([{"i": 0}])
+    with open(path, "ab") as f:
+        # A writer killed in the middle of a record
+        f.write(b'{"i":')
+
+    journal.append_logs([{"i": 1}])
+
+    assert journal.read_logs(0) == [{"i": 0}, {"i": 1}]
+    assert FileJournal(path).read_logs(1) == [{"i": 1}]
+
+
+def optimize(path):
+    study = optuna.load_study(study_name="study", storage=optuna.storages.JournalStorage(FileJournal(path)))
+    study.optimize(lambda trial: trial.suggest_float("x", 0, 1), n_trials=10)
+
+
+def test_concurrent_studies(tmp_path):
+    path = str(tmp_path / "journal.log")
+    optuna.create_study(study_name="study", storage=optuna.storages.JournalStorage(FileJournal(path)))
+
+    processes = [multiprocessing.get_context("spawn").Process(target=optimize, args=(path,)) for _ in range(N_WRITERS)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    study = optuna.load_study(study_name="study", storage=optuna.storages.JournalStorage(FileJournal(path)))
+    trials = study.get_trials(states=[optuna.trial.TrialState.COMPLETE])
+    assert len(trials) == N_WRITERS * 10
+    assert sorted(t.number for t in trials) == list(range(N_WRITERS * 10))